@@ -6,70 +6,259 @@ Created by Justin Wheelock (justin.wheelock@yale.edu)
 # main function for running the acquired epilepsy detection algorithm
 
 """
-Required inputs (put inside /inputs): 
+Required inputs (put inside /inputs, or point to them with --input / --patients / --notes):
     patients.csv:
-        containing columns "PatientID" and "admit_date" 
+        containing columns "PatientID" and "admit_date"
     notes.csv:
         containing columns "PatientID", "Date","NoteID", "NoteTXT"
+
+Run everything on every patient with:
+    python main.py
+and see python main.py --help for the paths, patient and stage selection, workers, chunk size and memory budget
 """
 
-import os 
-from os.path import join as opj 
-import pandas as pd 
+import os
+import sys
+import re
+import argparse
+from os.path import join as opj
+import pandas as pd
 from utils import runBaseline_helper
 from utils import runPatientLevel_helper
 from utils import runNoteLevel_helper
-from utils import plotEpilepsyTrends
+from utils.feature_schema import schema_from_models
+from utils.bin_cube import note_level_cube
+from utils import notes_index
+
+STAGES = ['baseline', 'note-level', 'patient-level', 'plots']
+
+# in-memory size of a row of notes while it is processed, as a multiple of its size once read (text copies, tokens...)
+ROW_OVERHEAD = 4
+
+
+def parse_size(size):
+    """
+    Bytes in a size like 8G, 512MB or 1000000
+    """
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', size.lower())
+    if match is None:
+        raise argparse.ArgumentTypeError('not a size: {}'.format(size))
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2) or ' '))
+
+
+def parse_rows(rows):
+    """
+    slice of the rows of patients.csv from START:END (either may be left out)
+    """
+
+    match = re.fullmatch(r'(-?\d*):(-?\d*)', rows)
+    if match is None:
+        raise argparse.ArgumentTypeError('not a START:END row range: {}'.format(rows))
+    return slice(*(int(i) if i else None for i in match.groups()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Identify acquired epilepsy after an acute brain injury from clinical notes')
+
+    paths = parser.add_argument_group('paths')
+    paths.add_argument('--input', default=opj(os.getcwd(),'input'), help='folder with patients.csv and notes.csv (default: ./input)')
+    paths.add_argument('--patients', help='patients csv (default: INPUT/patients.csv)')
+    paths.add_argument('--notes', help='notes csv (default: INPUT/notes.csv)')
+    paths.add_argument('--output', default=opj(os.getcwd(),'output'), help='folder for the predictions and figures (default: ./output)')
+    paths.add_argument('--cache-dir', help='folder the stem and sentence caches are kept in between runs, it can be shared by several jobs (default: OUTPUT/cache)')
+
+    selection = parser.add_argument_group('patient selection (default: every patient)')
+    selection.add_argument('--patient-ids', nargs='+', metavar='ID', help='only these PatientIDs')
+    selection.add_argument('--patient-ids-file', metavar='FILE', help='only the PatientIDs listed in this file, one per line')
+    selection.add_argument('--patient-rows', type=parse_rows, metavar='START:END', help='only these rows of the patients csv, e.g. 10:15')
+
+    run = parser.add_argument_group('run')
+    run.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                     help='stages to run (default: all). a stage that is left out is read from the files an earlier run saved')
+    run.add_argument('--workers', type=int, default=1,
+                     help='processes used for extracting features from the notes (default: 1). each takes a batch of 1000 notes at a time, '
+                          'so 1000 notes or fewer extracted at a time (see --chunk-size) are extracted in one process')
+    run.add_argument('--tokenizer', choices=['nltk', 'fast'], default='nltk',
+                     help="'fast' memoizes Punkt's sentence breaks and splits words with regexes, for the same sentences and words as nltk on cleaned "
+                          "text several times faster. build_binary_features_test_only.check_tokenizer_parity compares the two on your data")
+    run.add_argument('--sparse', action='store_true', help='keep the note features as a sparse matrix from extraction to scoring')
+    run.add_argument('--compact', action='store_true', help='compact dtypes (uint8 features, categorical PatientID, float32 probabilities)')
+    run.add_argument('--chunk-size', type=int, help='number of notes read or extracted at a time (default: from --memory-budget, otherwise 100000)')
+    run.add_argument('--memory-budget', type=parse_size, metavar='SIZE',
+                     help='memory for the notes processed at a time, e.g. 8G. sets --chunk-size from the size of the rows of the notes csv')
+    run.add_argument('--stream', action='store_true',
+                     help='stream the notes csv instead of reading it at once: it is read, extracted and scored a chunk at a time, so memory follows '
+                          '--chunk-size / --memory-budget and not the size of the csv (implies --sparse)')
+    run.add_argument('--no-index', action='store_true', help='read the whole notes csv even if it has an up to date index (see python -m utils.notes_index)')
+    run.add_argument('--temp-dir', help='with --stream, folder for the notes kept from each chunk until they are extracted (default: the system temporary folder)')
+
+    args = parser.parse_args(argv)
+
+    args.patients = args.patients or opj(args.input,'patients.csv')
+    args.notes = args.notes or opj(args.input,'notes.csv')
+    args.sparse = args.sparse or args.stream
+    args.cache_dir = args.cache_dir or opj(args.output,'cache')
+
+    return args
+
+
+def chunk_rows(notes_path, memory_budget, sample=1000):
+    """
+    Number of rows of the notes csv that fit in memory_budget bytes while they are processed, from the size of its first rows
+    """
+
+    head = pd.read_csv(notes_path, nrows=sample)
+    rowBytes = head.memory_usage(deep=True).sum() / max(len(head), 1) * ROW_OVERHEAD
+    return max(int(memory_budget / rowBytes), 1)
+
+
+def select_patients(patients, args):
+    """
+    The rows of patients picked by --patient-rows, --patient-ids and --patient-ids-file (all of them if none is given).
+    Raises a ValueError if they pick none
+    """
+
+    if args.patient_rows is not None:
+        patients = patients[args.patient_rows]
+
+    ids = list(args.patient_ids or [])
+    if args.patient_ids_file:
+        with open(args.patient_ids_file) as f:
+            ids += [line.strip() for line in f if line.strip()]
+    if ids:
+        patients = patients[patients.PatientID.astype(str).isin(ids)]
+
+    if len(patients) == 0:
+        raise ValueError('no admission in {} matches the patient selection (--patient-rows, --patient-ids, --patient-ids-file)'.format(args.patients))
+
+    return patients.reset_index(drop=True)
+
+
+def read_notes(notes_path, ids=None, chunk_size=100000):
+    """
+    notes csv, only the notes of the patients ids if given (read a chunk at a time, so the other notes are never all in memory)
+    """
+
+    if ids is None:
+        return pd.read_csv(notes_path)
+
+    chunks = [chunk[chunk.PatientID.isin(ids)] for chunk in pd.read_csv(notes_path, chunksize=chunk_size)]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_note_level(output, patients):
+    """
+    Note-level predictions an earlier run saved to output, for the selected patients. They must have been computed for all of them
+    """
+
+    predictions = opj(output,'note_level_predictions.csv')
+    if not os.path.isfile(predictions):
+        raise ValueError('no note-level predictions in {}, run the note-level step first'.format(output))
+    runBaseline_helper.check_cohort(opj(output,'note_level_predictions_patients.csv'), patients, 'note-level predictions', 'note-level')
+
+    noteLevel_output = pd.read_csv(predictions, index_col=0, parse_dates=['Date'])
+    return noteLevel_output[noteLevel_output.PatientID.astype(str).isin(patients.PatientID.astype(str))]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    path = os.path.dirname(os.path.abspath(__file__)) # utils/ and models/
+    path_train = opj(path,'utils')
+    model_directory = opj(path,'models')
+    os.makedirs(args.output, exist_ok=True)
+
+    chunk_size = args.chunk_size
+    if chunk_size is None:
+        chunk_size = chunk_rows(args.notes, args.memory_budget) if args.memory_budget else 100000
+
+    allPatients = pd.read_csv(args.patients)
+    patients = select_patients(allPatients, args)
+    print('{} of {} admissions selected, notes read {} rows at a time'.format(len(patients), len(allPatients), chunk_size))
+
+    # features are extracted in the column layout of the baseline and note-level models
+    schema = schema_from_models(path_train, model_directory)
+
+    #------------------------------------------------------------------------
+    # Run baseline phenotyping algorithm
+    #------------------------------------------------------------------------
+    if 'baseline' in args.stages and args.stream:
+        print('step one: running baseline phenotyping algorithm, streaming the notes...')
+
+        scores = runBaseline_helper.stream_scores(patients=patients,notes_path=args.notes,path=path,path_train=path_train,scores_path=args.output,n_workers=args.workers,tokenizer=args.tokenizer,schema=schema,compact=args.compact,chunk_size=chunk_size,temp_dir=args.temp_dir,cache_dir=args.cache_dir)
 
-path = os.getcwd()
+        print('done! on to step 2...')
+        print('')
+    elif 'baseline' in args.stages:
+        print('step one: running baseline phenotyping algorithm...')
 
-patients = pd.read_csv(opj(path,'input','patients.csv'))
-notes = pd.read_csv(opj(path,'input','notes.csv'))
+        # with an up to date index of the notes csv (python -m utils.notes_index), only the notes of the patients in their windows are read
+        index = None if args.no_index else notes_index.load_index(args.notes)
+        if index is not None:
+            notes = notes_index.read_patient_notes(args.notes, patients, index)
+        else:
+            ids = None if len(patients) == len(allPatients) else patients.PatientID.unique()
+            notes = read_notes(args.notes, ids, chunk_size)
 
-# decide whether you want to create plots for each patient
-plot_patients = 1
+        df_notes = runBaseline_helper.build_cohort_deidentified(patients=patients,notes=notes,path=path,n_workers=args.workers,tokenizer=args.tokenizer,sparse=args.sparse,schema=schema,compact=args.compact,chunk_size=chunk_size,cache_dir=args.cache_dir)
+        del notes
 
-# remove later, but for testing purposes limit to 5 patients
-patients = patients[10:15].reset_index(drop=True)
-notes = notes[notes.PatientID.isin(patients.PatientID.to_list())]
+        scores = runBaseline_helper.assign_scores(df_notes=df_notes,path_train=path_train,compact=args.compact,scores_path=args.output,patients=patients)
+        del df_notes
 
-#------------------------------------------------------------------------
-# Run baseline phenotyping algorithm
-#------------------------------------------------------------------------
-print('step one: running baseline phenotyping algorithm...')
+        print('done! on to step 2...')
+        print('')
+    else:
+        # the baseline scores an earlier run saved to the output folder, for the selected patients
+        scores = runBaseline_helper.load_scores(args.output, sparse=args.sparse, schema=schema, patients=patients)
 
-df_notes = runBaseline_helper.build_cohort_deidentified(patients=patients,notes=notes,path=path)
+    #------------------------------------------------------------------------
+    # method 2: note-level identification (its scores are binned once for method 1 and the plots)
+    #------------------------------------------------------------------------
+    cube = None
+    noteLevel_output = None
+    if 'note-level' in args.stages:
+        print('step two: running note-level epilepsy identification...')
 
-scores = runBaseline_helper.assign_scores(df_notes=df_notes,path_train=opj(path,'utils'))
+        noteLevel_output = runNoteLevel_helper.score(patients=patients,scores=scores,temp_path=path_train,model_directory=model_directory,compact=args.compact)
 
-print('done! on to step 2...')
-print('')
+        noteLevel_output.to_csv(opj(args.output,'note_level_predictions.csv'))
+        runBaseline_helper.save_cohort(patients, opj(args.output,'note_level_predictions_patients.csv'))
+        print('')
+    elif 'plots' in args.stages:
+        # only plotted: the patient-level model below bins the baseline scores of this run instead
+        if 'baseline' in args.stages:
+            print('warning: plotting the note-level predictions of an earlier run, not of the baseline scores computed now')
+        noteLevel_output = read_note_level(args.output, patients)
 
-#------------------------------------------------------------------------
-# method 1: patient-level identification
-#------------------------------------------------------------------------
-print('step two: running patient-level epilepsy identification...')
+    # weekly and monthly bins of the baseline and adjusted scores of every admission, read by the plots and (when the note-level
+    # step ran now) the patient-level model
+    if noteLevel_output is not None:
+        cube = note_level_cube(noteLevel_output, patients)
 
-patientLevel_output = runPatientLevel_helper.score(patients=patients,scores=scores,temp_path=opj(path,'utils'),model_directory=opj(path,'models'))
+    #------------------------------------------------------------------------
+    # method 1: patient-level identification
+    #------------------------------------------------------------------------
+    if 'patient-level' in args.stages:
+        print('step three: running patient-level epilepsy identification...')
 
-patientLevel_output.to_csv(opj(path,'output','patient_level_predictions.csv'))
-print('')
+        patientLevel_output = runPatientLevel_helper.score(patients=patients,scores=scores,temp_path=path_train,model_directory=model_directory,compact=args.compact,
+                                                            cube=cube if 'note-level' in args.stages else None)
 
-#------------------------------------------------------------------------
-# method 2: note-level identification
-#------------------------------------------------------------------------
-print('step three: running note-level epilepsy identification...')
+        patientLevel_output.to_csv(opj(args.output,'patient_level_predictions.csv'))
 
-noteLevel_output = runNoteLevel_helper.score(patients=patients,scores=scores,temp_path=opj(path,'utils'),model_directory=opj(path,'models'))
+    print('done! plot individual patients?')
 
-noteLevel_output.to_csv(opj(path,'output','note_level_predictions.csv'))
+    #------------------------------------------------------------------------
+    # optional: plot individual patient trajectories
+    #------------------------------------------------------------------------
 
-print('done! plot individual patients?')
+    if 'plots' in args.stages:
+        from utils import plotEpilepsyTrends # matplotlib and seaborn are only imported when there are plots to make
+        plotEpilepsyTrends.plot(patients=patients,scores=noteLevel_output,output_path=opj(args.output,'figs'),cube=cube)
+        print('figures saved to {}'.format(opj(args.output,'figs')))
 
-#------------------------------------------------------------------------
-# optional: plot individual patient trajectories
-#------------------------------------------------------------------------
 
-if plot_patients:
-    plotEpilepsyTrends.plot(patients=patients,scores=noteLevel_output,output_path=opj(path,'output','figs'))
-    print('figures saved to output/figs')
+if __name__ == '__main__':
+    main(sys.argv[1:])
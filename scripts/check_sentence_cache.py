@@ -0,0 +1,65 @@
+"""
+Check that a persisted sentence memo is discarded once a bag of words changes
+"""
+
+# a sentence is memoized with a copy of the bags of words and saved, one bag of the copy is changed so the sentence fires it,
+# and the memo is loaded again from the file under the fingerprint of the changed bags. the bags of the extractor module are
+# never modified, so nothing else extracting in the same process is affected.
+#
+# run from the repository root with:
+#     python scripts/check_sentence_cache.py
+
+import sys
+import os
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import build_binary_features_test_only as features
+from utils.stem_helper import SentenceCache, StemCache
+
+
+def fires(sentence, bags, name, sentence_cache):
+    """
+    Whether sentence fires the feature name with these bags of words, going through sentence_cache
+    """
+
+    columnMap = features.feature_column_map()
+    matrix = np.zeros((1, max(columnMap.values()) + 1), dtype=np.uint8)
+    matcher = features.build_matcher(bags, features.aeds)
+    features.extract_rows([sentence], 0, matrix, columnMap, StemCache(), 1, prefilter=False, sentence_cache=sentence_cache, matcher=matcher)
+    return bool(matrix[0, columnMap[name]])
+
+
+def check_sentence_cache(path=None):
+    """
+    Returns True if the memo is kept while the bags are unchanged, and discarded (so the sentence fires the changed bag) once one changes
+    """
+
+    bags = dict(features.antiEpilepsyBagOfWords, **features.proEvidences)
+    name = next(iter(features.proEvidences))
+    changedBags = dict(bags, **{name: {'zebra'}})
+    sentence = 'the patient was seen with a zebra.'
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = path or os.path.join(directory, 'sentence_cache.pkl')
+
+        memo = SentenceCache(path=path, fingerprint=features.features_fingerprint(bags=bags))
+        before = fires(sentence, bags, name, memo)
+        memo.save()
+        kept = len(SentenceCache(path=path, fingerprint=features.features_fingerprint(bags=bags)).entries) == len(memo.entries) > 0
+
+        changed = SentenceCache(path=path, fingerprint=features.features_fingerprint(bags=changedBags))
+        discarded = len(changed.entries) == 0
+        after = fires(sentence, changedBags, name, changed)
+
+    ok = kept and discarded and not before and after
+    print('sentence cache: kept with the same bags {}, discarded after a bag changed {}, changed bag fires {} -> {}: {}'.format(
+        kept, discarded, before, after, 'OK' if ok else 'FAILED'))
+
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_sentence_cache() else 1)
@@ -0,0 +1,145 @@
+"""
+Time-binned scores shared by the patient-level model and the plots
+"""
+
+# the patient-level model bins the scores of every admission episode in 3-month blocks and the plots bin the baseline and
+# adjusted scores again in weekly blocks. here the scores are aggregated once, per episode, per whole week and month since
+# admission, for several score columns at once, and any set of blocks from makeBins (weeks, months, 3 or 6 months...) is
+# rolled up from those cells.
+#
+# blocks include both ends, so a score exactly on the end of a block also counts in the next one. each unit offset k
+# therefore has two cells: the scores with offset k (admit + k <= date < admit + k+1), and the ones exactly on admit + k.
+# the block [s, e] is the first kind of cell for s..e-1 plus the second kind for e, which never counts a score twice.
+
+import numpy as np
+import pandas as pd
+from utils import trend_helper
+
+# probability of a block without any score, the baseline probability w/ no information (as in trend_helper.parseScores)
+NO_SCORE_PROBABILITY = 0.2138259917276594
+
+
+class BinCube:
+    """
+    Number of scores, number of hits and highest probability per (score series, id, unit offset), for weeks and months.
+
+    Inputs:
+        ids: the ids (e.g. EpisodeID) of the cube rows, sorted
+        series: names of the score series
+        cells: unit ('week'/'month') -> (counts, hits, probs), arrays of shape (series, ids, 2, offsets). the third axis
+            is the scores with that offset, then the scores exactly on it. probs is -inf where no score has a probability
+    """
+
+    def __init__(self, ids, series, cells):
+        self.ids = np.asarray(ids)
+        self.series = list(series)
+        self.cells = cells
+
+    @classmethod
+    def from_scores(cls, scores, series, id_col='EpisodeID', nYears=2):
+        """
+        Aggregate the scores of every id in one pass per unit.
+
+        Inputs:
+            scores: dataframe with id_col and the integer timeline columns (trend_helper.tagEpisodes(timeline=True) or addTimeline)
+            series: score series name -> (model answer column, probability column)
+            id_col: column of the ids
+            nYears: length of the timeline kept, in years from admission
+        """
+
+        scores = scores.drop_duplicates()
+        ids = np.unique(scores[id_col])
+        row = pd.Index(ids).get_indexer(scores[id_col].to_numpy())
+
+        days = scores['DayOffset'].to_numpy()
+        units = {'week': (days // 7, scores['DayExact'].to_numpy() & (days % 7 == 0), 52 * nYears),
+                 'month': (scores['MonthOffset'].to_numpy(), scores['MonthExact'].to_numpy(), 12 * nYears)}
+
+        hit = np.stack([scores[answer].to_numpy() == 1 for answer, _ in series.values()])
+        prob = np.stack([scores[probability].to_numpy(dtype=float) for _, probability in series.values()])
+
+        cells = dict()
+        for unit, (offset, exact, nOffsets) in units.items():
+            shape = (len(series), len(ids), 2, nOffsets + 1)
+            counts = np.zeros(shape, dtype=np.int32)
+            hits = np.zeros(shape, dtype=np.int32)
+            probs = np.full(shape, -np.inf)
+
+            inRange = (offset >= 0) & (offset <= nOffsets)
+            for kind, keep in enumerate((inRange, inRange & exact)):
+                r, k = row[keep], offset[keep]
+                for s in range(len(series)):
+                    np.add.at(counts[s, :, kind], (r, k), 1)
+                    np.add.at(hits[s, :, kind], (r, k), hit[s, keep])
+                    np.fmax.at(probs[s, :, kind], (r, k), prob[s, keep]) # missing probabilities are skipped, like a groupby max
+
+            cells[unit] = (counts, hits, probs)
+
+        return cls(ids, series, cells)
+
+    def blocks(self, name, unit, blockStarts, blockEnds):
+        """
+        Number of scores, number of hits and highest probability of every id in each block [start, end] of one unit,
+        as arrays of shape (blocks, ids)
+        """
+
+        counts, hits, probs = (a[self.series.index(name)] for a in self.cells[unit])
+        last = counts.shape[-1] - 1
+
+        # explicit shapes, so a cube without ids gives empty blocks
+        shape = (len(blockStarts), len(self.ids))
+        n, h, p = np.zeros(shape, dtype=counts.dtype), np.zeros(shape, dtype=hits.dtype), np.full(shape, -np.inf)
+        for block, (start, end) in enumerate(zip(blockStarts, blockEnds)):
+            span = slice(min(start, last + 1), min(end, last + 1))
+            point = end if end <= last else None
+            n[block] = counts[:, 0, span].sum(axis=1) + (counts[:, 1, point] if point is not None else 0)
+            h[block] = hits[:, 0, span].sum(axis=1) + (hits[:, 1, point] if point is not None else 0)
+            p[block] = np.max(np.column_stack([probs[:, 0, span], probs[:, 1, point] if point is not None else np.full(len(self.ids), -np.inf)]), axis=1)
+
+        return n, h, p
+
+    def trends(self, name, blockStarts, blockEnds, blockLabels, id_col='EpisodeID'):
+        """
+        Time-based features of one score series in the blocks of makeBins, the same dataframe trend_helper.parseScores returns
+        """
+
+        blocks = np.arange(len(blockLabels))
+        units = np.array(['month' if 'month' in l else 'week' if 'week' in l else '' for l in blockLabels])
+
+        hits = np.zeros((len(blockLabels), len(self.ids)))
+        prob = np.full((len(blockLabels), len(self.ids)), NO_SCORE_PROBABILITY)
+        for unit in ('week', 'month'):
+            unitBlocks = blocks[units == unit]
+            if len(unitBlocks) == 0:
+                continue
+            n, h, p = self.blocks(name, unit, np.asarray(blockStarts)[unitBlocks], np.asarray(blockEnds)[unitBlocks])
+            hits[unitBlocks] = h
+            prob[unitBlocks] = np.where(n > 0, np.where(p == -np.inf, np.nan, p), NO_SCORE_PROBABILITY)
+
+        ids = np.tile(self.ids, len(blockLabels))
+        if np.issubdtype(ids.dtype, np.number):
+            ids = ids.astype(float)
+
+        return pd.DataFrame({id_col: ids,
+                             'Time Interval': np.repeat(np.asarray(blockLabels, dtype=object), len(self.ids)),
+                             't': np.repeat(blocks.astype(float), len(self.ids)),
+                             'Number of Hits': hits.reshape(-1),
+                             'Highest Probability': prob.reshape(-1)},
+                            index=np.tile(np.arange(len(self.ids)), len(blockLabels)))
+
+    def nbytes(self):
+        return sum(a.nbytes for arrays in self.cells.values() for a in arrays)
+
+
+def note_level_cube(scores, patients):
+    """
+    BinCube of the baseline and adjusted scores ('baseline', 'adjusted') of every admission episode, from the output of
+    runNoteLevel_helper.score. The patient-level model and the plots both read it.
+    """
+
+    episodes = trend_helper.makeEpisodes(patients)
+    scores = pd.merge(scores, episodes[['PatientID','admit_date','EpisodeID']], on=['PatientID','admit_date'], how='inner')
+    scores = trend_helper.addTimeline(scores, admit_date_col='admit_date', date_col='Date')
+
+    return BinCube.from_scores(scores, {'baseline': ('baseline_answer', 'baseline_probability'),
+                                        'adjusted': ('adjusted_answer', 'adjusted_probability')})
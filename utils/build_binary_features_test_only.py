@@ -6,240 +6,690 @@ Created on Wed Jun  1 16:03:31 2022
 """
 
 
+from functools import lru_cache
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+import re
+import numpy as np
 import pandas as pd
-from nltk.tokenize import sent_tokenize, word_tokenize
-from nltk.stem.snowball import SnowballStemmer
-
-
-def build_matrix_features(n, col):
-
-    antiEpilepsyBagOfWords = {'evid': {'not', 'evid', 'diagnosi', 'epilepsi'},
-                          'recommend': {'not', 'recommend', 'antiepilept', 'medic'},
-                          'defer sz': {'defer', 'anti', 'seizur'},
-                          'defer med': {'defer', 'anti', 'epilept'},
-                          'refer': {'referr', 'gener', 'neurolog'},
-                          'follow up': {'not', 'requir', 'follow', 'up'},
-                          'followup': {'not', 'requir', 'followup'},
-                          'cannot': {'cannot', 'event', 'epilept'},
-                          'pnes': {'pnes'},
-                          'nosz': {'no', 'seizur', 'event'},
-                          'unlikely': {'unlik', 'seizur'},
-                          'fnd': {'function', 'neurolog', 'disord'},
-                          'migraine': {'migrain'},
-                          'anxiety': {'anxieti'},
-                          'syncope': {'syncop'},
-                          'cd': {'convers', 'disord'},
-                          'psycho': {'psychogen'},
-                          'risk': {'not', 'have', 'seizur', 'risk', 'factor'},
-                          'sleep': {'sleep', 'disord'},
-                          'apnea': {'sleep', 'apnea'},
-                          'test': {'not', 'recommend', 'test'},
-                          'suspicion': {'low', 'suspicion', 'seizur'},
-                          'tremor': {'physiolog', 'tremor'},
-                          '"seizures"': {"''", 'seizur'},
-                          'fn': {'function', 'neurolog'},
-                          'vasovagal': {'vasovag'},
-                          'pcp': {'defer', 'primary', 'care', 'physician'},
-                          'definition': {'not', 'meet', 'definit', 'epilepsi'},
-                          'support': {'not', 'support', 'diagnosi', 'epilepsi'},
-                          'amnesia': {'amnesia'},
-                          'provoke': {'provok', 'seizur'},
-                          'depression': {'dispress'},
-                          'shiver': {'shiver'},
-                          'arrest': {'cardiac', 'arrest'},
-                          'noanti': {'no', 'anti', 'seizur', 'medic'},
-                          'neuropathy': {'neuropathi'},
-                          'neuropathic': {'neuropath'},
-                          'meningioma': {'meningioma'},
-                          'holdoff': {'hold', 'off', 'start', 'anti', 'epilept'},
-                          'diabetes': {'diabet'},
-                          'neurosarcoidosis': {'neurosarcoidosi'},
-                          'sdh': {'sdh'},
-                          'postoper': {'post', 'oper'},
-                          'hemorrhage': {'traumat', 'hemorrhag'},
-                          'concern': {'low', 'concern', 'seizur'},
-                          'noconcern': {'no', 'concern', 'seizur'},
-                          'convince': {'not', 'convinc', 'seizur'},
-                          'follow': {'not', 'need', 'follow', 'epilepsi'},
-                          'notfollowup': {'not', 'need', 'followup'},
-                          'start': {'not', 'start', 'antiepilept', 'medic'},
-                          'startsz': {'not', 'start', 'antiseizur', 'medic'},
-                          'cause': {'unlik', 'epilepsi'},
-                          'trauma': {'trauma'},
-                          'traumatic': {'traumat'},
-                          'hematoma': {'hematoma'},
-                          'abscess': {'brain', 'abscess'},
-                          'hold': {'hold', 'off', 'medic'},
-                          'postop': {'postop'},
-                          'single': {'singl', 'seizur'},
-                          'singlesz': {'singl', 'sz'},
-                          'funcevents': {'function', 'event'},
-                          'asneeded': {'follow', 'up', 'as', 'need'},
-                          'asneededfollow': {'followup', 'as', 'need'},
-                          'referpsy': {'referr', 'psychiatri'},
-                          'defermed': {'defer', 'medic'},
-                          'acute': {'acut', 'symptomat', 'seizur'},
-                          'symptomatic': {'symptomat', 'seizur'},
-                          'first': {'first', 'time', 'seizur'},
-                          'lifetime': {'one', 'lifetim', 'seizur'},
-                          'evidence': {'no', 'evid', 'seizur'},                          
-                          'meet': {'not', 'meet', 'epilepsi'},
-                          'notneedmedic': {'not', 'need', 'medic'},
-                          'jacobsen': {'jacobsen', 'syndrom'},
-                          'alcohol': {'excess', 'alcohol'},
-                          'exam': {'normal', 'neurolog', 'exam'},
-                          'mri': {'normal', 'mri'},
-                          'eeg':{'normal', 'eeg'},
-                          'eprisk': {'no', 'epilepsi', 'risk'},
-                          'factors': {'no', 'epilepsi', 'risk', 'factor'},
-                          'epileptiform': {'no', 'epileptiform', 'abnorm'},
-                          'psychiatric': {'psychiatr'},
-                          'fentanyl': {'fentanyl'},
-                          'bipolar': {'bipolar'},
-                          'not have': {'not', 'have', 'epilepsi'},
-                          'bite': {'no', 'bite'},
-                          'incontinence': {'no', 'incontin'},
-                          'lowthres': {'low', 'seizur', 'threshold'},
-                          'lowerthres': {'lower', 'seizur', 'threshold'},
-                          'antisz': {'no', 'antiseizur', 'medic'},
-                          'had': {'not', 'had', 'seizur'},
-                          'nonepileptic': {'nonepilept'},
-                          'chemo': {'chemo'},
-                          'chemotherapy': {'chemotherapi'},
-                          'epileptogenic': {'no', 'epileptogen', 'abnorm'},
-                          'numb': {'numb'},
-                          'surgery': {'surgeri'},
-                          'discharge': {'discharg', 'epilepsi', 'clinic'},
-                          'nonepileptiform': {'nonepileptiform'},
-                          'non epileptiform': {'non', 'epileptiform'},
-                          'not epileptic': {'not', 'epilept'},
-                          'dementia': {'dementia'},
-                          'think': {'not', 'think', 'epilepsi'},
-                          'diagnose': {'no', 'diagnosi', 'epilepsi'},
-                          'tingling': {'tingl'},
-                          'activity': {'not', 'epileptiform', 'activ'},
-                          'noseizure': {'no', 'seizur'},
-                          'withdrawal': {'withdraw', 'seizur'},
-                          'dizzy': {'dizzi'},
-                          'maintain': {'maintain', 'conscious'},
-                          'electrograph': {'no', 'electrograph', 'seizur'},
-                           'wean': {'wean', 'off'},
-                           'taper': {'taper'},
-                          'resect': {'resect'},
-                          'second': {'second', 'opinion'},
-                          'definite': {'definit', 'diagnosi', 'epilepsi'},
-                          'pseudoseizure': {'pseudoseizur'},
-                           'cardiology': {'cardiolog'},
-                           'againstsz': {'against', 'seizur'},
-                           'against': {'against', 'epilepsi'},
-                          'ptsd': {'ptsd'},
-                          'pneslong': {'psychogen', 'nonepilept', 'seizur'},
-                          'presyncope': {'presyncop'},
-                          'hypoglycemia': {'hypoglycemia'},
-                          'doubt': {'doubt', 'seizur'},
-                          'carry': {'not', 'carri', 'diagnosi', 'epilepsi'},
-                          'acutesz': {'acut', 'seizur'},
-                          'deny': {'deni', 'seizur'},
-                          'spell': {'provok', 'spell'},
-                          'non epileptic': {'non', 'epilept', 'spell'},
-                          'non  epileptic': {'nonepilept', 'spell'},
-                          'insomnia': {'insomnia'},
-                          'migraine aura': {'migrain', 'aura'},
-                          'clinical': {'no', 'clinic', 'seizur'},
-                          'criteria': {'not', 'criteria', 'epilepsi'}}
-
-    proEvidences = {'both': {'both', 'epilepsi', 'pnes'},
-                  'mixed dis': {'mix', 'disord'},
-                  'ictal': {'ictal'},
-                'aura': {'aura'},
-                'convulse': {'convuls'},
-                'breakthrough': {'breakthrough', 'seizur'},
-                'focal': {'focal'},
-                'idiopathic': {'idiopath', 'general', 'epilepsi'},
-                'history': {'histori', 'seizur'},
-                'hx': {'hx', 'seizur'},
-                'complex': {'complex', 'seizur'},
-                'partial': {'partial', 'seizur'},
-                'myoclonic': {'myoclon'},
-                'generalized': {'general', 'seizur'},
-                'continue': {'continu', 'on'},
-                'drive': {'drive', 'month'},
-                'szdrive': {'drive', 'seizur'},
-                'deja': {'deja', 'vu'},
-                'seizurefree': {'seizurefre'},
-                'szfree': {'szfree'},
-                'seizure free': {'seizur', 'free'},
-                'sz free':{'sz', 'free'},
-                'frontallobe': {'frontal', 'lobe'},
-                'nocturnal': {'nocturn'},
-                'febrile': {'febril'},
-                'perinatal': {'perinat', 'complic'},
-                'control': {'seizur','control'}, 
-                'monotherapy': {'monotherapi'},
-                'absence': {'absenc', 'seizur'},
-                'dejavu': {'dejavu'},
-                'postictal': {'postict', 'confus'},
-                'tonicclonic': {'tonniclon'},
-                'tonic clonic': {'tonic', 'clonic'}, 
-                'sudden': {'sudden', 'unexpect', 'death'},
-                'sudep': {'sudep'},
-                'droop': {'facial', 'droop'},
-                'intractable': {'intract', 'epilepsi'},
-                'daily': {'daili', 'seizur'},
-                'decreased': {'decreas', 'seizur'},
-                'device': {'devic'},
-                'surgical': {'surgic', 'intervent'},
-                'reprogram': {'reprogram'},
-                'abnormaleeg': {'abnorm', 'eeg'},
-                'with': {'with', 'epilepsi'},
-                'juvenile': {'juvenil', 'epilespi'},
-                'myoclonus': {'myoclonus'},
-                'recurrent': {'recurr', 'sz'},
-                'recurrents': {'recurr', 'seizur'},
-                'noncompliance': {'noncompli'},
-                # 'szdisorder': {'seizur', 'disord'},
-                'stable': {'seizur', 'stabl'},
-                'shoulder': {'disloc', 'shoulder'},
-                'narcolepsy': {'narcolepsi'},
-                'sleep clinic': {'sleep', 'clinic'}}
-                
-    aeds = ['acetazolamid', 'acth',
-        'acthar', 'brivaracetam',
-        'briviact', 'cannabidiol' , 'epidiolex',
-        'carbamazepin', 'cbz', 'epitol', 'tegretol', 'equetro', 'teril',
-         'carbatrol', 'tegretol', 'epitol', 'cenobam', 'xcopri',
-         'clobazam', 'frisium', 'onfi', 'sympazan', 'clonazepam',
-         'epitril', 'klonopin', 'rivotril', 'clorazep', 'tranxen',
-         'xene', 'diazepam', 'valium' , 'diamox',
-         'diastat', 'divalproex', 'depakot', 'eslicarbazepin', 'aptiom',
-         'ethosuximid', 'zarontin', 'ethotoin', 'ezogabin', 'potiga',
-         'felbam', 'felbatol', 'gabapentin', 'neurontin', 'gralis',
-         'horiz', 'lacosamid', 'vimpat', 'lamotrigin', 'lamict',
-         'levetiracetam', 'ltg', 'ige', 'tpm', 'oxc', 'lev', 'keppra', 'roweepra', 'spritam',
-         'elepsia', 'lorazepam', 'ativan', 'methsuximid', 'methosuximid',
-         'celontin', 'oxcarbazepin', 'trilept', 'oxtellar xr', 'perampanel',
-        'fycompa', 'phenobarbit', 'luminol', 'lumin', 'phenytoin',
-         'epanutin', 'dilantin', 'phenytek', 'pregabalin', 'lyrica',
-         'primidon', 'mysolin', 'rufinamid', 'banzel', 'inovelon', 'percocet',
-         'stiripentol', 'diacomit', 'tiagabin', 'gabitril', 'topiram', 'topamax',
-         'topiram',  'qudexi', 'trokendi', 'valproat', 'valproic', 'wellbutrin',
-         'convulex', 'depacon', 'depaken', 'orfiril', 'valpor', 'valprosid',
-         'depakot', 'vigabatrin', 'sabril', 'vigadron', 'zonisamid', 'zonegran', 'xanax', 'cocaine']
+import scipy.sparse
+from utils.stem_helper import SentenceCache, StemCache, get_sentence_cache, get_stem_cache
+from utils.sparse_features import SparseFeatures
+from utils.feature_schema import get_schema
+
+
+antiEpilepsyBagOfWords = {'evid': {'not', 'evid', 'diagnosi', 'epilepsi'},
+                      'recommend': {'not', 'recommend', 'antiepilept', 'medic'},
+                      'defer sz': {'defer', 'anti', 'seizur'},
+                      'defer med': {'defer', 'anti', 'epilept'},
+                      'refer': {'referr', 'gener', 'neurolog'},
+                      'follow up': {'not', 'requir', 'follow', 'up'},
+                      'followup': {'not', 'requir', 'followup'},
+                      'cannot': {'cannot', 'event', 'epilept'},
+                      'pnes': {'pnes'},
+                      'nosz': {'no', 'seizur', 'event'},
+                      'unlikely': {'unlik', 'seizur'},
+                      'fnd': {'function', 'neurolog', 'disord'},
+                      'migraine': {'migrain'},
+                      'anxiety': {'anxieti'},
+                      'syncope': {'syncop'},
+                      'cd': {'convers', 'disord'},
+                      'psycho': {'psychogen'},
+                      'risk': {'not', 'have', 'seizur', 'risk', 'factor'},
+                      'sleep': {'sleep', 'disord'},
+                      'apnea': {'sleep', 'apnea'},
+                      'test': {'not', 'recommend', 'test'},
+                      'suspicion': {'low', 'suspicion', 'seizur'},
+                      'tremor': {'physiolog', 'tremor'},
+                      '"seizures"': {"''", 'seizur'},
+                      'fn': {'function', 'neurolog'},
+                      'vasovagal': {'vasovag'},
+                      'pcp': {'defer', 'primary', 'care', 'physician'},
+                      'definition': {'not', 'meet', 'definit', 'epilepsi'},
+                      'support': {'not', 'support', 'diagnosi', 'epilepsi'},
+                      'amnesia': {'amnesia'},
+                      'provoke': {'provok', 'seizur'},
+                      'depression': {'dispress'},
+                      'shiver': {'shiver'},
+                      'arrest': {'cardiac', 'arrest'},
+                      'noanti': {'no', 'anti', 'seizur', 'medic'},
+                      'neuropathy': {'neuropathi'},
+                      'neuropathic': {'neuropath'},
+                      'meningioma': {'meningioma'},
+                      'holdoff': {'hold', 'off', 'start', 'anti', 'epilept'},
+                      'diabetes': {'diabet'},
+                      'neurosarcoidosis': {'neurosarcoidosi'},
+                      'sdh': {'sdh'},
+                      'postoper': {'post', 'oper'},
+                      'hemorrhage': {'traumat', 'hemorrhag'},
+                      'concern': {'low', 'concern', 'seizur'},
+                      'noconcern': {'no', 'concern', 'seizur'},
+                      'convince': {'not', 'convinc', 'seizur'},
+                      'follow': {'not', 'need', 'follow', 'epilepsi'},
+                      'notfollowup': {'not', 'need', 'followup'},
+                      'start': {'not', 'start', 'antiepilept', 'medic'},
+                      'startsz': {'not', 'start', 'antiseizur', 'medic'},
+                      'cause': {'unlik', 'epilepsi'},
+                      'trauma': {'trauma'},
+                      'traumatic': {'traumat'},
+                      'hematoma': {'hematoma'},
+                      'abscess': {'brain', 'abscess'},
+                      'hold': {'hold', 'off', 'medic'},
+                      'postop': {'postop'},
+                      'single': {'singl', 'seizur'},
+                      'singlesz': {'singl', 'sz'},
+                      'funcevents': {'function', 'event'},
+                      'asneeded': {'follow', 'up', 'as', 'need'},
+                      'asneededfollow': {'followup', 'as', 'need'},
+                      'referpsy': {'referr', 'psychiatri'},
+                      'defermed': {'defer', 'medic'},
+                      'acute': {'acut', 'symptomat', 'seizur'},
+                      'symptomatic': {'symptomat', 'seizur'},
+                      'first': {'first', 'time', 'seizur'},
+                      'lifetime': {'one', 'lifetim', 'seizur'},
+                      'evidence': {'no', 'evid', 'seizur'},                          
+                      'meet': {'not', 'meet', 'epilepsi'},
+                      'notneedmedic': {'not', 'need', 'medic'},
+                      'jacobsen': {'jacobsen', 'syndrom'},
+                      'alcohol': {'excess', 'alcohol'},
+                      'exam': {'normal', 'neurolog', 'exam'},
+                      'mri': {'normal', 'mri'},
+                      'eeg':{'normal', 'eeg'},
+                      'eprisk': {'no', 'epilepsi', 'risk'},
+                      'factors': {'no', 'epilepsi', 'risk', 'factor'},
+                      'epileptiform': {'no', 'epileptiform', 'abnorm'},
+                      'psychiatric': {'psychiatr'},
+                      'fentanyl': {'fentanyl'},
+                      'bipolar': {'bipolar'},
+                      'not have': {'not', 'have', 'epilepsi'},
+                      'bite': {'no', 'bite'},
+                      'incontinence': {'no', 'incontin'},
+                      'lowthres': {'low', 'seizur', 'threshold'},
+                      'lowerthres': {'lower', 'seizur', 'threshold'},
+                      'antisz': {'no', 'antiseizur', 'medic'},
+                      'had': {'not', 'had', 'seizur'},
+                      'nonepileptic': {'nonepilept'},
+                      'chemo': {'chemo'},
+                      'chemotherapy': {'chemotherapi'},
+                      'epileptogenic': {'no', 'epileptogen', 'abnorm'},
+                      'numb': {'numb'},
+                      'surgery': {'surgeri'},
+                      'discharge': {'discharg', 'epilepsi', 'clinic'},
+                      'nonepileptiform': {'nonepileptiform'},
+                      'non epileptiform': {'non', 'epileptiform'},
+                      'not epileptic': {'not', 'epilept'},
+                      'dementia': {'dementia'},
+                      'think': {'not', 'think', 'epilepsi'},
+                      'diagnose': {'no', 'diagnosi', 'epilepsi'},
+                      'tingling': {'tingl'},
+                      'activity': {'not', 'epileptiform', 'activ'},
+                      'noseizure': {'no', 'seizur'},
+                      'withdrawal': {'withdraw', 'seizur'},
+                      'dizzy': {'dizzi'},
+                      'maintain': {'maintain', 'conscious'},
+                      'electrograph': {'no', 'electrograph', 'seizur'},
+                       'wean': {'wean', 'off'},
+                       'taper': {'taper'},
+                      'resect': {'resect'},
+                      'second': {'second', 'opinion'},
+                      'definite': {'definit', 'diagnosi', 'epilepsi'},
+                      'pseudoseizure': {'pseudoseizur'},
+                       'cardiology': {'cardiolog'},
+                       'againstsz': {'against', 'seizur'},
+                       'against': {'against', 'epilepsi'},
+                      'ptsd': {'ptsd'},
+                      'pneslong': {'psychogen', 'nonepilept', 'seizur'},
+                      'presyncope': {'presyncop'},
+                      'hypoglycemia': {'hypoglycemia'},
+                      'doubt': {'doubt', 'seizur'},
+                      'carry': {'not', 'carri', 'diagnosi', 'epilepsi'},
+                      'acutesz': {'acut', 'seizur'},
+                      'deny': {'deni', 'seizur'},
+                      'spell': {'provok', 'spell'},
+                      'non epileptic': {'non', 'epilept', 'spell'},
+                      'non  epileptic': {'nonepilept', 'spell'},
+                      'insomnia': {'insomnia'},
+                      'migraine aura': {'migrain', 'aura'},
+                      'clinical': {'no', 'clinic', 'seizur'},
+                      'criteria': {'not', 'criteria', 'epilepsi'}}
+
+proEvidences = {'both': {'both', 'epilepsi', 'pnes'},
+              'mixed dis': {'mix', 'disord'},
+              'ictal': {'ictal'},
+            'aura': {'aura'},
+            'convulse': {'convuls'},
+            'breakthrough': {'breakthrough', 'seizur'},
+            'focal': {'focal'},
+            'idiopathic': {'idiopath', 'general', 'epilepsi'},
+            'history': {'histori', 'seizur'},
+            'hx': {'hx', 'seizur'},
+            'complex': {'complex', 'seizur'},
+            'partial': {'partial', 'seizur'},
+            'myoclonic': {'myoclon'},
+            'generalized': {'general', 'seizur'},
+            'continue': {'continu', 'on'},
+            'drive': {'drive', 'month'},
+            'szdrive': {'drive', 'seizur'},
+            'deja': {'deja', 'vu'},
+            'seizurefree': {'seizurefre'},
+            'szfree': {'szfree'},
+            'seizure free': {'seizur', 'free'},
+            'sz free':{'sz', 'free'},
+            'frontallobe': {'frontal', 'lobe'},
+            'nocturnal': {'nocturn'},
+            'febrile': {'febril'},
+            'perinatal': {'perinat', 'complic'},
+            'control': {'seizur','control'}, 
+            'monotherapy': {'monotherapi'},
+            'absence': {'absenc', 'seizur'},
+            'dejavu': {'dejavu'},
+            'postictal': {'postict', 'confus'},
+            'tonicclonic': {'tonniclon'},
+            'tonic clonic': {'tonic', 'clonic'}, 
+            'sudden': {'sudden', 'unexpect', 'death'},
+            'sudep': {'sudep'},
+            'droop': {'facial', 'droop'},
+            'intractable': {'intract', 'epilepsi'},
+            'daily': {'daili', 'seizur'},
+            'decreased': {'decreas', 'seizur'},
+            'device': {'devic'},
+            'surgical': {'surgic', 'intervent'},
+            'reprogram': {'reprogram'},
+            'abnormaleeg': {'abnorm', 'eeg'},
+            'with': {'with', 'epilepsi'},
+            'juvenile': {'juvenil', 'epilespi'},
+            'myoclonus': {'myoclonus'},
+            'recurrent': {'recurr', 'sz'},
+            'recurrents': {'recurr', 'seizur'},
+            'noncompliance': {'noncompli'},
+            # 'szdisorder': {'seizur', 'disord'},
+            'stable': {'seizur', 'stabl'},
+            'shoulder': {'disloc', 'shoulder'},
+            'narcolepsy': {'narcolepsi'},
+            'sleep clinic': {'sleep', 'clinic'}}
+            
+aeds = ['acetazolamid', 'acth',
+    'acthar', 'brivaracetam',
+    'briviact', 'cannabidiol' , 'epidiolex',
+    'carbamazepin', 'cbz', 'epitol', 'tegretol', 'equetro', 'teril',
+     'carbatrol', 'tegretol', 'epitol', 'cenobam', 'xcopri',
+     'clobazam', 'frisium', 'onfi', 'sympazan', 'clonazepam',
+     'epitril', 'klonopin', 'rivotril', 'clorazep', 'tranxen',
+     'xene', 'diazepam', 'valium' , 'diamox',
+     'diastat', 'divalproex', 'depakot', 'eslicarbazepin', 'aptiom',
+     'ethosuximid', 'zarontin', 'ethotoin', 'ezogabin', 'potiga',
+     'felbam', 'felbatol', 'gabapentin', 'neurontin', 'gralis',
+     'horiz', 'lacosamid', 'vimpat', 'lamotrigin', 'lamict',
+     'levetiracetam', 'ltg', 'ige', 'tpm', 'oxc', 'lev', 'keppra', 'roweepra', 'spritam',
+     'elepsia', 'lorazepam', 'ativan', 'methsuximid', 'methosuximid',
+     'celontin', 'oxcarbazepin', 'trilept', 'oxtellar xr', 'perampanel',
+    'fycompa', 'phenobarbit', 'luminol', 'lumin', 'phenytoin',
+     'epanutin', 'dilantin', 'phenytek', 'pregabalin', 'lyrica',
+     'primidon', 'mysolin', 'rufinamid', 'banzel', 'inovelon', 'percocet',
+     'stiripentol', 'diacomit', 'tiagabin', 'gabitril', 'topiram', 'topamax',
+     'topiram',  'qudexi', 'trokendi', 'valproat', 'valproic', 'wellbutrin',
+     'convulex', 'depacon', 'depaken', 'orfiril', 'valpor', 'valprosid',
+     'depakot', 'vigabatrin', 'sabril', 'vigadron', 'zonisamid', 'zonegran', 'xanax', 'cocaine']
+
+
+# columns merged together after extraction, (kept, merged into it)
+joinedColumns = [('history', 'hx'),
+                 ('follow up', 'followup'),
+                 ('sz free', 'szfree'),
+                 ('seizure free', 'seizurefree'),
+                 ('sz free', 'seizure free'),
+                 ('carbamazepin', 'cbz'),
+                 ('lamotrigin', 'ltg'),
+                 ('levetiracetam', 'lev'),
+                 ('oxcarbazepin', 'oxc'),
+                 ('topamax', 'tpm'),
+                 ('lowthres', 'lowerthres'),
+                 ('chemo', 'chemotherapy'),
+                 ('epileptiform', 'epileptogenic'),
+                 ('deja', 'dejavu'),
+                 ('tonic clonic', 'tonicclonic'),
+                 ('nonepileptiform', 'non epileptiform'),
+                 ('asneeded', 'asneededfollow'),
+                 ('recurrent', 'recurrents'),
+                 ('single', 'singlesz'),
+                 ('non epileptic', 'non  epileptic')]
+
+
+def features_fingerprint(schema=None, bags=None):
+    """
+    Hash of the bags of words, medications and joined columns (and of the schema columns if given): what the features
+    fired by a sentence depend on. A persisted SentenceCache saved under another fingerprint is discarded.
+    bags: dict of feature name -> stems to hash instead of antiEpilepsyBagOfWords and proEvidences
+    """
+
+    if bags is None:
+        bags = dict(antiEpilepsyBagOfWords, **proEvidences)
+    bags = [(name, sorted(stems)) for name, stems in bags.items()]
+    described = repr((bags, list(aeds), list(joinedColumns), list(schema.columns) if schema is not None else None))
+    return hashlib.blake2b(described.encode('utf-8'), digest_size=16).digest()
+
+
+@lru_cache(maxsize=None)
+def compile_matcher():
+    """
+    Compile the bag-of-stems dictionaries (antiEpilepsyBagOfWords, proEvidences and aeds) once into an inverted index, see build_matcher
+    """
+
+    return build_matcher(dict(antiEpilepsyBagOfWords, **proEvidences), aeds)
+
+
+def build_matcher(bags, aeds):
+    """
+    Compile bags of stems (dict of feature name -> stems) and medication stems into an inverted index.
+
+    Every bag is filed under a single trigger stem (the one shared by the fewest bags), so a
+    sentence only checks the bags whose trigger it actually contains instead of all of them.
+
+    Returns a dict with:
+        index: trigger stem -> list of (feature name, frozenset of stems)
+        aeds: frozenset of medication stems, which fire on their own
+    """
+
+    # how many bags each stem appears in; rare stems make the most selective triggers
+    counts = dict()
+    for stems in bags.values():
+        for stem in stems:
+            counts[stem] = counts.get(stem, 0) + 1
+
+    index = dict()
+    for name, stems in bags.items():
+        trigger = min(stems, key=lambda x: (counts[x], x))
+        index.setdefault(trigger, []).append((name, frozenset(stems)))
+
+    return {'index': index, 'aeds': frozenset(aeds)}
+
+
+def match_stems(matcher, stem_words):
+    """
+    Return the set of feature names fired by one sentence, given its stemmed words.
+    Same result as testing every bag with issubset and every stem against aeds.
+    """
+
+    stems = set(stem_words)
+    found = set(stems & matcher['aeds'])
+
+    index = matcher['index']
+    for stem in stems:
+        for name, bag in index.get(stem, ()):
+            if bag <= stems:
+                found.add(name)
+
+    return found
+
+
+# prefilter: every word token of cleaned text (only [a-z0-9 .]) is one of these runs, except the pieces
+# the Treebank tokenizer splits off a few contractions
+_words = re.compile(r'[a-z0-9]+')
+_unclean = re.compile(r'[^a-z0-9\s.]')
+_contractions = {'cannot': ('can', 'not'), 'gimme': ('gim', 'me'), 'gonna': ('gon', 'na'),
+                 'gotta': ('got', 'ta'), 'lemme': ('lem', 'me'), 'wanna': ('wan', 'na')}
+
+def could_fire(text, matcher, stem_cache):
+    """
+    Cheap check whether text can fire any feature, without sentence/word tokenizing it.
+    Stems every word run in the text (through StemCache.peek, which leaves the cache's hit rate and order alone) and runs the matcher
+    on all of them at once: the stems of any sentence are a subset of these, so if nothing matches here nothing can match after tokenizing.
+    Text with characters outside [a-z0-9 .] (not cleaned by merge_notes) always passes.
+    """
+
+    if _unclean.search(text):
+        return True
+
+    words = set(_words.findall(text))
+    for word in words.intersection(_contractions):
+        words.update(_contractions[word])
+
+    return bool(match_stems(matcher, stem_cache.peek(words).values()))
+
+
+# fast tokenizer: Punkt's own sentence breaks with its per-break decisions memoized, and a regex stand-in for the Treebank word
+# tokenizer on cleaned text ([a-z0-9 .] only)
+_ellipsis = re.compile(r'\.{2,}')
+_contraction = re.compile(r'\b(can)(not)\b|\b(gim)(me)\b|\b(gon)(na)\b|\b(got)(ta)\b|\b(lem)(me)\b|\b(wan)(na)(?=\s)') # Treebank's, cleaned text only
+
+@lru_cache(maxsize=None)
+def _nltk_tokenizers():
+    # nltk takes seconds to import (it pulls in scipy.stats and sklearn), so it is only imported when it first tokenizes a note
+    from nltk.tokenize import sent_tokenize, word_tokenize
+    return sent_tokenize, word_tokenize
+
+
+def sent_tokenize(text):
+    return _nltk_tokenizers()[0](text)
+
+
+def word_tokenize(sentence):
+    return _nltk_tokenizers()[1](sentence)
+
+
+@lru_cache(maxsize=None)
+def _punkt():
+    # the english Punkt model sent_tokenize uses
+    from nltk.tokenize.punkt import PunktTokenizer
+    return PunktTokenizer('english')
+
+
+@lru_cache(maxsize=2**16)
+def _contains_sentbreak(context):
+    # Punkt decides each potential break from its context alone (the word before the period and the token after it),
+    # and the same contexts come back over and over in clinical notes
+    return _punkt().text_contains_sentbreak(context)
+
+
+@lru_cache(maxsize=None)
+def _has_potential_ends():
+    # fast_sent_tokenize walks the potential breaks with a private method of Punkt (nltk 3.9.1, pinned in requirements.txt)
+    if hasattr(_punkt(), '_match_potential_end_contexts'):
+        return True
+    print('warning: this version of nltk has no PunktTokenizer._match_potential_end_contexts, the fast tokenizer splits sentences with sent_tokenize')
+    return False
+
+
+def fast_sent_tokenize(text):
+    """
+    Split cleaned text into sentences exactly as sent_tokenize does: Punkt finds the same potential breaks (every period
+    followed by whitespace, a standalone "." included) and its decision for each one is memoized on its context, instead of
+    tokenizing and annotating the context again every time. Punkt moves breaks past closing quotes and brackets, which
+    cleaned text never has; text with any other character than [a-z0-9 .] is left to sent_tokenize.
+    The potential breaks come from Punkt's private _match_potential_end_contexts, as in nltk 3.9.1 (the version in requirements.txt).
+    With an nltk that does not have it, every text is left to sent_tokenize (same sentences, without the speed-up).
+    """
+
+    if _unclean.search(text) or not _has_potential_ends():
+        return sent_tokenize(text)
+
+    sentences = []
+    start = 0
+    for match, context in _punkt()._match_potential_end_contexts(text):
+        if _contains_sentbreak(context):
+            sentences.append(text[start:match.end()])
+            start = match.start('next_tok') if match.group('next_tok') else match.end()
+    sentences.append(text[start:len(text.rstrip())])
+
+    return [sentence for sentence in sentences if sentence]
+
+
+def fast_word_tokenize(sentence):
+    """
+    Split a cleaned sentence into words like word_tokenize does: on whitespace, around ellipses, off the final period
+    and into the pieces of the Treebank contractions (wherever they are on word boundaries). Punctuation-only tokens never fire a feature and are left out.
+    Sentences with any other character than [a-z0-9 .] are left to word_tokenize.
+    """
+
+    if _unclean.search(sentence):
+        return word_tokenize(sentence)
+
+    words = _ellipsis.sub(' ', sentence).split()
+    if words and words[-1].endswith('.'):
+        words[-1] = words[-1][:-1]
+        if not words[-1]:
+            words.pop()
+
+    # the Treebank contractions split wherever they start and end on a word boundary, also inside a token (cannot.x -> can not .x)
+    text = ' '.join(words) + ' '
+    if not _contraction.search(text):
+        return words
+
+    return [word for word in _contraction.sub(_splitContraction, text).split() if word.strip('.')]
+
+
+def _splitContraction(match):
+    return ' ' + ' '.join(piece for piece in match.groups() if piece) + ' '
+
+
+tokenizers = {'nltk': (sent_tokenize, word_tokenize),
+              'fast': (fast_sent_tokenize, fast_word_tokenize)}
+
+
+def new_prefilter_counts():
+    return {'notes': 0, 'notes_skipped': 0, 'chars': 0, 'chars_skipped': 0, 'sentences': 0, 'sentences_skipped': 0}
+
+
+def report_prefilter(counts):
+    print('prefilter: skipped {} of {} notes ({:.1%} of text) and {} of {} sentences in the remaining notes'.format(
+        counts['notes_skipped'], counts['notes'], counts['chars_skipped'] / max(counts['chars'], 1),
+        counts['sentences_skipped'], counts['sentences']))
+
+
+def extract_rows(notes, start, matrix, columnMap, stem_cache, batch_size, prefilter=True, counts=None, sentence_cache=None, tokenizer='nltk', matcher=None):
+    """
+    Tokenize, stem and match a list of (normalized) notes, setting the hits in rows start.. of matrix.
+    With prefilter, notes and sentences that cannot fire any feature skip tokenizing; counts (see new_prefilter_counts) records how many.
+    With a sentence_cache, sentences already seen (in this or earlier batches) reuse their features instead of being tokenized again.
+    tokenizer picks the sentence/word tokenizers from tokenizers ('nltk' or 'fast').
+    matcher: output of build_matcher to match with (default: compile_matcher(), the bags of this module)
+    """
+
+    if matcher is None:
+        matcher = compile_matcher()
+    sentTokenize, wordTokenize = tokenizers[tokenizer]
+    # the memo is keyed per tokenizer, since the same sentence can give different words
+    salt = b'' if tokenizer == 'nltk' else tokenizer.encode('utf-8') + b'\x00'
+    if counts is None:
+        counts = new_prefilter_counts()
+
+    for first in range(0, len(notes), batch_size):
+        # new sentences of the whole batch are tokenized first, then their vocabulary is stemmed in one go
+        pending = dict() # sentence key -> word tokens
+        noteSentences = [] # per note: features already known, keys of its pending sentences
+        for note in notes[first:first+batch_size]:
+            note = str(note)
+            found = set()
+            keys = []
+            noteSentences.append((found, keys))
+
+            counts['notes'] += 1
+            counts['chars'] += len(note)
+            if prefilter and not could_fire(note, matcher, stem_cache):
+                counts['notes_skipped'] += 1
+                counts['chars_skipped'] += len(note)
+                continue
+
+            sentences = sentTokenize(note)
+            counts['sentences'] += len(sentences)
+            for sentence in sentences:
+                key = SentenceCache.key(sentence, salt)
+                if key in pending:
+                    keys.append(key)
+                    continue
+                if sentence_cache is not None:
+                    features = sentence_cache.get(key)
+                    if features is not None:
+                        found |= features
+                        continue
+                if prefilter and not could_fire(sentence, matcher, stem_cache):
+                    counts['sentences_skipped'] += 1
+                    if sentence_cache is not None:
+                        sentence_cache.put(key, ())
+                    continue
+                pending[key] = wordTokenize(sentence)
+                keys.append(key)
+
+        stemmed = stem_cache.stem_sentences(list(pending.values()))
+
+        fired = dict()
+        for key, stem_words in zip(pending, stemmed):
+            fired[key] = match_stems(matcher, stem_words)
+            if sentence_cache is not None:
+                sentence_cache.put(key, fired[key])
+
+        for index, (found, keys) in enumerate(noteSentences, start+first):
+            for key in keys:
+                found |= fired[key]
+
+            for feature in found:
+                matrix[index, columnMap[feature]] = 1
+
+
+# state held by each extraction worker process: the shared feature array, column map and its own copy of the caches
+_worker = dict()
+
+def _init_worker(shm_name, shape, columnMap, prefilter, stem_cache, sentence_cache, tokenizer):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['matrix'] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    _worker['columnMap'] = columnMap
+    _worker['prefilter'] = prefilter
+    _worker['stem_cache'] = stem_cache
+    _worker['sentence_cache'] = sentence_cache
+    _worker['tokenizer'] = tokenizer
+    for cache in _worker_caches():
+        cache.track_added()
+    compile_matcher()
+
+
+def _worker_caches(stem_cache=None, sentence_cache=None):
+    # the caches whose counts and new entries go back to the parent process (the stem cache, its prefilter stems, the sentence memo)
+    stem_cache = stem_cache if stem_cache is not None else _worker['stem_cache']
+    sentence_cache = sentence_cache if sentence_cache is not None else _worker['sentence_cache']
+    caches = [stem_cache, stem_cache.prefilterStems]
+    return caches + [sentence_cache] if sentence_cache is not None else caches
+
+
+def _extract_chunk(task):
+    start, notes = task
+    caches = _worker_caches()
+    before = [(c.hits, c.misses) for c in caches]
+    counts = new_prefilter_counts()
+    extract_rows(notes, start, _worker['matrix'], _worker['columnMap'], _worker['stem_cache'], len(notes), _worker['prefilter'], counts, _worker['sentence_cache'], _worker['tokenizer'])
+    return [(c.hits - hits, c.misses - misses, c.take_added()) for c, (hits, misses) in zip(caches, before)], counts
+
+
+def extract_rows_parallel(notes, matrix, columnMap, stem_cache, batch_size, n_workers, prefilter=True, counts=None, sentence_cache=None, tokenizer='nltk'):
+    """
+    Same as extract_rows over all notes, but chunks of batch_size notes are processed by n_workers processes.
+    Workers write their rows straight into a shared-memory copy of matrix, so the result is identical to a serial run.
+    Each worker starts from a copy of the caches and sends back, with every chunk, its hit/miss counts and the entries it
+    added, which are merged into the caches here (so they are saved with the new stems and sentences, as after a serial run).
+    """
+
+    shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+    try:
+        shared = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)
+        shared[:] = 0
+
+        tasks = ((start, notes[start:start+batch_size]) for start in range(0, len(notes), batch_size))
+        initargs = (shm.name, matrix.shape, columnMap, prefilter, stem_cache, sentence_cache, tokenizer)
+        caches = _worker_caches(stem_cache, sentence_cache)
+        with multiprocessing.get_context().Pool(n_workers, initializer=_init_worker, initargs=initargs) as pool:
+            for lookups, chunk_counts in pool.imap_unordered(_extract_chunk, tasks):
+                for cache, (hits, misses, added) in zip(caches, lookups):
+                    cache.hits += hits
+                    cache.misses += misses
+                    cache.merge(added)
+                if counts is not None:
+                    for key in counts:
+                        counts[key] += chunk_counts[key]
+
+        matrix[:] = shared
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def feature_column_map():
+    """
+    Fixed column map into the preallocated feature array, feature name -> column (aeds repeats a few names, they share a column).
+    The layout of the schema without any model columns, see feature_schema.py
+    """
+
+    return get_schema().sourceIndex
+
+
+def check_tokenizer_parity(n, col, sample=1000, seed=0, normalized=False, tokenizer='fast'):
+    """
+    Run the nltk tokenizers and another tokenizer backend on a random sample of notes and report every
+    note-level feature where they disagree, to certify the faster backend on a dataset.
+
+    Inputs:
+        n: dataframe of notes, one row per patient-day (as passed to build_matrix_features)
+        col: name of the note text column
+        sample: number of notes to compare (all notes if there are fewer)
+        seed: random seed for the sample
+        normalized: same as in build_matrix_features
+        tokenizer: backend to compare against nltk
+
+    Returns a dataframe with one row per disagreement: the row of n, the feature and whether each tokenizer fired it
+    """
+
+    n = n.sample(n=min(sample, len(n)), random_state=seed)
+    if normalized:
+        notes = n[col].str.lstrip(' ').tolist()
+    else:
+        notes = n[col].str.lower().str.replace(r'\s+', ' ', regex=True).str.strip().tolist()
+
+    columnMap = feature_column_map()
+    matrices = dict()
+    for backend in ('nltk', tokenizer):
+        matrices[backend] = np.zeros((len(notes), len(columnMap)), dtype=np.uint8)
+        extract_rows(notes, 0, matrices[backend], columnMap, StemCache(), len(notes) or 1, prefilter=False, tokenizer=backend)
+
+    names = list(columnMap)
+    rows, cols = np.nonzero(matrices['nltk'] != matrices[tokenizer])
+    disagreements = pd.DataFrame({'row': n.index[rows], 'feature': [names[i] for i in cols],
+                                  'nltk': matrices['nltk'][rows, cols], tokenizer: matrices[tokenizer][rows, cols]})
+
+    # sentence splits too, they may differ without changing any feature on this sample
+    sent_tokenizer = tokenizers[tokenizer][0]
+    splits = sum(sent_tokenize(note) != sent_tokenizer(note) for note in notes)
+
+    print('tokenizer parity ({} vs nltk): {} of {} notes disagree on {} features, {} are split into different sentences'.format(
+        tokenizer, disagreements['row'].nunique(), len(notes), len(disagreements), splits))
+    if len(disagreements):
+        print(disagreements.groupby('feature').size().sort_values(ascending=False).head(20).to_string())
+
+    return disagreements
+
+
+def build_matrix_features(n, col, stem_cache=None, batch_size=1000, n_workers=1, prefilter=True, sentence_cache=None, memo=True, normalized=False, tokenizer='nltk', sparse=False, chunk_size=100000, schema=None, compact=False):
+    """
+    Inputs:
+        n: dataframe of notes, one row per patient-day
+        col: name of the note text column
+        stem_cache: StemCache shared across calls/runs. defaults to the process-wide cache
+        batch_size: number of notes tokenized together, so each unique word is stemmed once per batch
+        n_workers: number of processes for tokenizing/matching, each taking batch_size notes at a time. 1 runs everything in this process,
+            and so does extracting at most batch_size notes (too few to split)
+        prefilter: skip tokenizing notes/sentences that cannot fire any feature (same output, see could_fire)
+        sentence_cache: SentenceCache memo of features per sentence, shared across calls/runs. defaults to the process-wide memo
+        memo: set to False to tokenize every sentence, without the sentence memo
+        normalized: text already comes from merge_notes(lower=True), i.e. lowercase with whitespace collapsed
+        tokenizer: 'nltk' (Punkt + Treebank, default) or 'fast' (regex, see fast_sent_tokenize). check_tokenizer_parity compares the two
+        sparse: return a SparseFeatures (CSR matrix over every row of n and every feature column) instead of a dense dataframe
+        chunk_size: in sparse mode, number of notes extracted into a dense buffer at a time before it is compressed
+        schema: FeatureSchema the features are written in (see feature_schema.py). defaults to the bag features only.
+            in sparse mode the matrix columns are the schema columns, so the models it was built for score it without reordering
+        compact: dense features as uint8 columns, with zeros instead of NaN in the rows without any feature (same rows and order)
+    """
 
-    
     names = list(antiEpilepsyBagOfWords.keys()) + list(proEvidences.keys()) + aeds
-    matrix = pd.DataFrame(columns = names)
-    columns = list()
-       
-    matrix[names] = 0 
 
-    stemmer = SnowballStemmer(language='english')
+    # fixed column map into the preallocated feature array, in the schema layout (aeds repeats a few names, they share a column)
+    if schema is None:
+        schema = get_schema()
+    columnMap = schema.sourceIndex
+
+    if stem_cache is None:
+        stem_cache = get_stem_cache()
+    if not memo:
+        sentence_cache = None
+    elif sentence_cache is None:
+        sentence_cache = get_sentence_cache()
     
     # n = pd.read_csv('C:/Users/cdac/Prodigy/No_ground_truth_1000_cases_epilepsy_clinic.csv')
     n = n.reset_index().drop(columns='index')
     #n = n.dropna()
-    n[col] = n[col].str.lower()
-    n[col] = n[col].apply(lambda x: " ".join(x.split()))
+    if normalized:
+        n[col] = n[col].str.lstrip(' ') # only the padding merge_notes adds to short texts is left
+    else:
+        n[col] = n[col].str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
     # n = n[n.patient_has_epilepsy != 'US']
     n = n.reset_index(drop=True)
     #n['patient_has_epilepsy'] = n.patient_has_epilepsy.map({'YES':2.0, 'NO':0.0, 'US': 1.0})
@@ -248,67 +698,67 @@ def build_matrix_features(n, col):
     # find if a sentence in each of the notes contains one of the key bags of words
     # if it does, add the note to the no epilepsy list
     print('tokenizing {} notes'.format(len(n)))
-    for index in range(len(n)):
-        # print(index)
-        note = n.iloc[index].get(col)
-        note = str(note)
-        sentences = sent_tokenize(note)
-        foundSentences = set()
-        matrix.loc[len(matrix)] = 0
-        for sentence in sentences:
-            words = word_tokenize(sentence)
-            stem_words = []
-
-            for w in words:
-                x = stemmer.stem(w)
-                stem_words.append(x)
-
-            for word in stem_words:
-                if word in aeds:
-                    matrix.loc[len(matrix)-1][word] = 1
-
-            for bag in antiEpilepsyBagOfWords:
-                if antiEpilepsyBagOfWords[bag].issubset(stem_words):
-                    matrix.loc[len(matrix)-1][bag] = 1
-                    
-            for bag in proEvidences:
-                if proEvidences[bag].issubset(stem_words):
-                    matrix.loc[len(matrix)-1][bag] = 1
+    notes = n[col].tolist()
+    counts = new_prefilter_counts()
+
+    extracted = min(len(notes), chunk_size) if sparse else len(notes) # notes extracted at a time
+    if n_workers > 1 and extracted <= batch_size:
+        print('{} notes extracted at a time fit in one batch of {}, extracting them in this process instead of {} workers'.format(extracted, batch_size, n_workers))
+
+    def extract(notes, matrix):
+        if n_workers > 1 and len(notes) > batch_size:
+            extract_rows_parallel(notes, matrix, columnMap, stem_cache, batch_size, n_workers, prefilter, counts, sentence_cache, tokenizer)
+        else:
+            extract_rows(notes, 0, matrix, columnMap, stem_cache, batch_size, prefilter, counts, sentence_cache, tokenizer)
+
+    if sparse:
+        # the schema columns for every row, joined and compressed a chunk of notes at a time
+        chunks = []
+        for first in range(0, len(notes), chunk_size):
+            matrix = np.zeros((len(notes[first:first+chunk_size]), schema.width), dtype=np.uint8)
+            extract(notes[first:first+chunk_size], matrix)
+            chunks.append(scipy.sparse.csr_matrix(schema.join(matrix)[:, :len(schema)]))
+        matrix = scipy.sparse.vstack(chunks, format='csr') if chunks else scipy.sparse.csr_matrix((0, len(schema)), dtype=np.uint8)
+    else:
+        matrix = np.zeros((len(n), schema.width), dtype=np.uint8)
+        extract(notes, matrix)
+
+    stem_cache.report()
+    if sentence_cache is not None:
+        sentence_cache.report()
+    if prefilter:
+        report_prefilter(counts)
+
+    if sparse:
+        # same row order as the dense frame below: the rows with a feature first, then the rest
+        hits = matrix.getnnz(axis=1) > 0
+        order = np.concatenate([np.flatnonzero(hits), np.flatnonzero(~hits)])
+        return SparseFeatures(n.iloc[order], matrix[order], schema.columns, schema=schema)
     
     #join like columns together
-    def join_columns(df, col1, col2):
-        df[col1] = df[col1] + df[col2]
-        df = df.drop(columns=[col2])
-        return df
-    
-    matrix = join_columns(matrix, 'history', 'hx')
-    matrix = join_columns(matrix, 'follow up', 'followup')
-    matrix = join_columns(matrix, 'sz free', 'szfree')
-    matrix = join_columns(matrix, 'seizure free', 'seizurefree') 
-    matrix = join_columns(matrix, 'sz free', 'seizure free') 
-    matrix = join_columns(matrix, 'carbamazepin', 'cbz')
-    matrix = join_columns(matrix, 'lamotrigin', 'ltg')
-    matrix = join_columns(matrix, 'levetiracetam', 'lev')
-    matrix = join_columns(matrix, 'oxcarbazepin', 'oxc')
-    matrix = join_columns(matrix, 'topamax', 'tpm')
-    matrix = join_columns(matrix, 'lowthres', 'lowerthres')
-    matrix = join_columns(matrix, 'chemo', 'chemotherapy')
-    matrix = join_columns(matrix, 'epileptiform', 'epileptogenic')
-    matrix = join_columns(matrix, 'deja', 'dejavu')
-    matrix = join_columns(matrix, 'tonic clonic', 'tonicclonic')
-    matrix = join_columns(matrix, 'nonepileptiform', 'non epileptiform')
-    matrix = join_columns(matrix, 'asneeded', 'asneededfollow')
-    matrix = join_columns(matrix, 'recurrent', 'recurrents')
-    matrix = join_columns(matrix, 'single', 'singlesz')
-    matrix = join_columns(matrix, 'non epileptic', 'non  epileptic')
+    schema.join(matrix)
+    added = {col2 for _, col2 in joinedColumns}
+    names = [i for i in names if i not in added]
 
     # no_features = matrix.loc[(matrix.sum(axis=1) == 0),]
     # no_features = no_features.join(n.Unstructured)
     # no_features = no_features['Unstructured']
     # no_features.to_csv('C:/Users/cdac/Prodigy/no_ground_truth_no_features_review.csv')
 
-    matrix = matrix.add_suffix('_')
-    matrix = matrix.loc[(matrix.sum(axis=1) != 0), (matrix != 0).any(axis=0)]
+    # back to the full column layout, then drop the empty rows and columns
+    matrix = matrix[:, [columnMap[i] for i in names]]
+    rows = matrix.any(axis=1)
+    cols = matrix.any(axis=0)
+
+    if compact:
+        # the layout below without going through NaN and int64: the rows with a feature first, then the rest
+        order = np.concatenate([np.flatnonzero(rows), np.flatnonzero(~rows)])
+        features = pd.DataFrame(matrix[order][:, cols], columns=[names[i] + '_' for i in np.flatnonzero(cols)])
+        return pd.concat([features, n.iloc[order].reset_index(drop=True)], axis=1)
+    
+    matrix = pd.DataFrame(matrix[rows][:, cols].astype(np.int64),
+                          columns=[names[i] + '_' for i in np.flatnonzero(cols)],
+                          index=np.flatnonzero(rows))
     
     # df_all = n.merge(matrix.drop_duplicates(), on=['PatientID', 'Date'], 
     #                how='left', indicator=True)
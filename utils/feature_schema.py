@@ -0,0 +1,125 @@
+"""
+Feature schema shared by the note feature extractor and the models
+"""
+
+# one fixed layout of feature columns, so the extractor writes straight into the column order the models take
+# and each model gets a precomputed projection, instead of adding and reordering columns by name on every run.
+#
+# layout of the extractor's working matrix:
+#   [ model columns (in the order of the first model, then any new ones of the next models) |
+#     extractor columns no model uses | bag features that are only added into another one (hx -> history, ...) ]
+# the first len(columns) columns are the schema; model columns the extractor never produces (e.g. const) stay zero
+
+from functools import lru_cache
+import numpy as np
+
+
+def extractor_features():
+    """
+    Feature names of the bags of words in extraction order (repeated names once), and the (kept, added) pairs joined after extraction
+    """
+
+    from utils.build_binary_features_test_only import antiEpilepsyBagOfWords, proEvidences, aeds, joinedColumns
+
+    names = list(dict.fromkeys(list(antiEpilepsyBagOfWords.keys()) + list(proEvidences.keys()) + aeds))
+    return names, joinedColumns
+
+
+class FeatureSchema:
+    """
+    Stable integer index for every feature column.
+
+    Inputs:
+        modelColumns: the ordered feature columns of each model that will score these features (list of lists).
+            the first model's columns come first, so its projection is the identity
+
+    Attributes:
+        columns: the feature columns of the schema, in order ('<bag feature>_' for extracted features)
+        index: column -> position
+        sourceIndex: bag feature name -> column of the extractor's working matrix it is written to
+        joins: (kept, added) pairs of working matrix columns, added in this order after extraction
+        width: number of columns of the working matrix (the schema columns, then the added-only features)
+    """
+
+    def __init__(self, modelColumns=()):
+        names, joinedColumns = extractor_features()
+        added = {col2 for _, col2 in joinedColumns}
+        produced = [i for i in names if i not in added]
+
+        columns = []
+        for model in modelColumns:
+            columns += list(model)
+        columns += [i + '_' for i in produced]
+        self.columns = list(dict.fromkeys(columns))
+        self.index = {c: i for i, c in enumerate(self.columns)}
+
+        self.sourceIndex = {i: self.index[i + '_'] for i in produced}
+        for i in names:
+            if i in added:
+                self.sourceIndex[i] = len(self.columns) + len(self.sourceIndex) - len(produced)
+        self.sourceIndex = dict(sorted(self.sourceIndex.items(), key=lambda item: item[1]))
+        self.width = len(self.columns) + len(self.sourceIndex) - len(produced)
+
+        self.joins = [(self.sourceIndex[col1], self.sourceIndex[col2]) for col1, col2 in joinedColumns]
+        self._projections = dict()
+
+    def __len__(self):
+        return len(self.columns)
+
+    def join(self, matrix):
+        """
+        Add the joined features of a working matrix (rows x width) into the ones they are kept under, in place
+        """
+
+        for col1, col2 in self.joins:
+            matrix[:, col1] += matrix[:, col2]
+        return matrix
+
+    def projection(self, features):
+        """
+        Position of each of the features in the schema, -1 for features it does not have (they are all zero). Cached per feature list.
+        """
+
+        key = tuple(features)
+        if key not in self._projections:
+            self._projections[key] = np.array([self.index.get(f, -1) for f in features], dtype=np.int64)
+        return self._projections[key]
+
+    def expand(self, coef, features):
+        """
+        Lay a model's coefficients out over the schema columns (zero for the columns the model does not use), so the model
+        scores schema-ordered rows without any column reordering. Features the schema does not have are always zero and drop out.
+        """
+
+        projection = self.projection(features)
+        found = projection >= 0
+        expanded = np.zeros(len(self.columns), dtype=np.asarray(coef).dtype)
+        expanded[projection[found]] = np.asarray(coef).reshape(-1)[found]
+        return expanded
+
+
+@lru_cache(maxsize=None)
+def _schema(modelColumns):
+    return FeatureSchema(modelColumns)
+
+
+def get_schema(modelColumns=()):
+    """
+    Shared FeatureSchema for the given model columns (one instance per distinct set of models)
+    """
+
+    return _schema(tuple(tuple(model) for model in modelColumns))
+
+
+def schema_from_models(path_train, model_directory):
+    """
+    Shared FeatureSchema for the models that score note features: the baseline model (its bundle in path_train, whose
+    columns come first) and the note-level model (parseFalsePositives_byNote.sav in model_directory)
+    """
+
+    from utils import model_registry
+
+    baseline = model_registry.load_model(model_registry.BASELINE, path_train)
+    noteLevel = model_registry.load_model(model_registry.NOTE_LEVEL, model_directory)
+
+    return get_schema([baseline.features, noteLevel.features])
@@ -0,0 +1,75 @@
+"""
+Import-time budget of the pipeline
+"""
+
+# the modules main.py imports at startup are timed in a fresh interpreter (python -X importtime), and the run fails if they
+# take longer than the budget or pull in a module that should only be imported on first use (nltk, sklearn, plotting...).
+# many small jobs pay this startup every time, so a regression here costs more than it looks.
+#
+# check it with:
+#     python -m utils.import_budget [budget in seconds]
+
+import sys
+import os
+import subprocess
+
+# what main.py imports before it starts working
+STARTUP_MODULES = ['utils.runBaseline_helper', 'utils.runPatientLevel_helper', 'utils.runNoteLevel_helper',
+                   'utils.feature_schema', 'utils.bin_cube', 'utils.model_registry', 'utils.notes_index']
+
+# only imported on first use: nltk when a note is tokenized or a word stemmed for the first time, sklearn and dill to read or
+# build the original models (not their .npz exports), matplotlib and seaborn to plot
+DEFERRED_MODULES = ['nltk', 'sklearn', 'dill', 'matplotlib', 'seaborn']
+
+BUDGET = 1.5 # seconds
+
+
+def measure(modules=STARTUP_MODULES):
+    """
+    Import the modules in a fresh interpreter with -X importtime.
+    Returns a dict of every imported module -> (self, cumulative) import time in seconds, and the total import time
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)],
+                            cwd=root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(', '.join(modules), result.stderr[-2000:]))
+
+    times = dict()
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own) / 1e6, int(cumulative) / 1e6)
+        if not name[1:].startswith(' '): # top-level import
+            total += int(cumulative) / 1e6
+
+    return times, total
+
+
+def check(budget=BUDGET, modules=STARTUP_MODULES, top=10):
+    """
+    Report the import time of the startup modules and the slowest imports.
+    Returns True if it is within budget and none of the deferred modules was imported.
+    """
+
+    times, total = measure(modules)
+
+    print('startup imports: {:.2f}s (budget {:.2f}s)'.format(total, budget))
+    for name, (own, cumulative) in sorted(times.items(), key=lambda item: -item[1][1])[:top]:
+        print('  {:>7.3f}s  {}'.format(cumulative, name))
+
+    eager = [m for m in DEFERRED_MODULES if m in times]
+    if eager:
+        print('imported at startup, should be deferred to first use: {}'.format(', '.join(eager)))
+
+    ok = total <= budget and not eager
+    print('OK' if ok else 'FAILED')
+
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check(float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET) else 1)
@@ -0,0 +1,187 @@
+"""
+NumPy inference for the logistic-regression models
+"""
+
+# the three models of the pipeline are all binary logistic regressions. their coefficients are pulled out once and every
+# batch is then scored with a single matrix-vector product, instead of several sklearn predict_proba calls that each
+# validate the feature names of the dataframe again. the features and coefficients are kept in float32, but the product
+# is summed in float64: with the hit counts of the patient-level model (in the hundreds) float32 sums drift from sklearn.
+#
+# check it against sklearn with:
+#     python -m utils.lr_inference [folder of the baseline model bundle] [folder of the patient and note level models]
+
+import sys
+import os
+from os.path import join as opj
+import pickle
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class LogisticModel:
+    """
+    Coefficients and intercept of a fitted binary logistic regression.
+
+    Inputs:
+        coef: one coefficient per feature
+        intercept: the intercept
+        features: optional ordered feature names. dataframes are then reordered to them before scoring
+        dtype: dtype the coefficients and feature matrices are kept in (float32 by default). the product is summed in float64
+        threshold: optional decision threshold stored with the model (the baseline model's comes from its training data)
+    """
+
+    def __init__(self, coef, intercept, features=None, dtype=np.float32, threshold=None):
+        self.dtype = dtype
+        self.coef = np.asarray(coef, dtype=dtype).reshape(-1)
+        self._coef64 = self.coef.astype(np.float64)
+        self.intercept = float(np.asarray(intercept).reshape(-1)[0])
+        self.features = list(features) if features is not None else None
+        self.threshold = threshold
+
+    @classmethod
+    def from_sklearn(cls, clf, features=None, dtype=np.float32, threshold=None):
+        """
+        Extract a LogisticModel from a fitted sklearn LogisticRegression, or from a Pipeline ending in one whose
+        other steps only pass the features through (as in lr_text_only_py3_repaired.sav)
+        """
+
+        if hasattr(clf, 'steps'):
+            for name, step in clf.steps[:-1]:
+                if not _is_identity(step):
+                    raise ValueError('pipeline step {} is not an identity transform, it cannot be folded into the coefficients'.format(name))
+            clf = clf.steps[-1][1]
+
+        if len(clf.classes_) != 2:
+            raise ValueError('only binary logistic regressions are supported')
+
+        if features is None and hasattr(clf, 'feature_names_in_'):
+            features = list(clf.feature_names_in_)
+
+        return cls(clf.coef_, clf.intercept_, features=features, dtype=dtype, threshold=threshold)
+
+    def on_schema(self, schema):
+        """
+        Same model over the columns of a FeatureSchema (see feature_schema.py): the coefficients are laid out in the schema
+        order, so schema-ordered matrices are scored as they are, without selecting or reordering columns
+        """
+
+        return LogisticModel(schema.expand(self.coef, self.features), self.intercept, features=schema.columns, dtype=self.dtype, threshold=self.threshold)
+
+    def save(self, path):
+        """
+        Save the model to an .npz file (coefficients, intercept, feature names and threshold), which load reads without sklearn or dill
+        """
+
+        np.savez(path, coef=self.coef, intercept=np.array([self.intercept]),
+                 features=np.array(self.features if self.features is not None else [], dtype=str),
+                 hasFeatures=np.array(self.features is not None),
+                 threshold=np.array([np.nan if self.threshold is None else self.threshold]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            threshold = float(f['threshold'][0])
+            return cls(f['coef'], f['intercept'], features=[str(i) for i in f['features']] if f['hasFeatures'] else None, dtype=f['coef'].dtype.type,
+                       threshold=None if np.isnan(threshold) else threshold)
+
+    def matrix(self, X):
+        """
+        Feature matrix of X in the dtype of the model, reordered to the model's features if X is a dataframe.
+        scipy.sparse matrices stay sparse.
+        """
+
+        if sparse.issparse(X):
+            return X.astype(self.dtype)
+        if isinstance(X, pd.DataFrame):
+            if self.features is not None:
+                X = X[self.features]
+            return X.to_numpy(dtype=self.dtype)
+        return np.asarray(X, dtype=self.dtype)
+
+    def decision_function(self, X):
+        return self.matrix(X) @ self._coef64 + self.intercept
+
+    def prob_yes(self, X):
+        """
+        Probability of the positive class for every row of X (what predict_proba(X)[:,1] returns)
+        """
+
+        return 1.0 / (1.0 + np.exp(-self.decision_function(X)))
+
+    def predict_proba(self, X):
+        p = self.prob_yes(X)
+        return np.column_stack([1.0 - p, p])
+
+
+def _is_identity(step):
+    # FunctionTransformer() without a function, alone or nested in single-branch pipelines and feature unions
+    if hasattr(step, 'transformer_list'):
+        return len(step.transformer_list) == 1 and getattr(step, 'transformer_weights', None) is None and _is_identity(step.transformer_list[0][1])
+    if hasattr(step, 'steps'):
+        return all(_is_identity(s) for _, s in step.steps)
+    return type(step).__name__ == 'FunctionTransformer' and step.func is None
+
+
+def check_parity(clf, X, tol=1e-6, name='model', dtype=np.float32):
+    """
+    Score X with sklearn and with the NumPy engine and check the positive-class probabilities agree to within tol.
+    Returns the largest absolute difference.
+    """
+
+    engine = LogisticModel.from_sklearn(clf, dtype=dtype)
+    expected = clf.predict_proba(X)[:,1]
+    got = engine.prob_yes(X)
+
+    diff = float(np.max(np.abs(expected - got))) if len(got) else 0.0
+    print('{}: max |sklearn - numpy| = {:.2e} over {} rows ({})'.format(name, diff, len(got), 'OK' if diff <= tol else 'FAILED'))
+
+    return diff
+
+
+def random_features(features, n=10000, seed=0, kind='binary'):
+    """
+    Random feature matrix for a parity check: sparse binary text features, or per-bin probabilities (p_) and hit counts (n_).
+    The counts go up to 300, the number of notes a patient can have in a bin
+    """
+
+    rng = np.random.default_rng(seed)
+    if kind == 'binary':
+        X = (rng.random((n, len(features))) < 0.1).astype(np.int64)
+    else:
+        X = np.column_stack([rng.random(n) if f.startswith('p_') else rng.integers(0, 301, n).astype(float) for f in features])
+    return pd.DataFrame(X, columns=features)
+
+
+def check_models(path_train, model_path, n=10000, tol=1e-6):
+    """
+    Parity check of the NumPy engine against sklearn for the three models of the pipeline, on random features.
+    The baseline model is skipped if path_train has neither its bundle nor the training data to build it.
+    Returns True if all the models checked agree to within tol.
+    """
+
+    from utils.model_bundle import load_bundle, BUNDLE_NAME
+
+    diffs = []
+    if os.path.isfile(opj(path_train, BUNDLE_NAME)) or os.path.isfile(opj(path_train,'X_train.csv')):
+        bundle = load_bundle(path_train)
+        diffs.append(check_parity(bundle['model'], random_features(bundle['features'], n), tol, 'baseline'))
+    else:
+        print('baseline: skipped, no {} or X_train.csv in {} to build it from'.format(BUNDLE_NAME, path_train))
+
+    with open(opj(model_path,'parseFalsePositives_byNote.sav'), 'rb') as f:
+        byNote = pickle.load(f)
+    with open(opj(model_path,'parseFP_epilepsy_lr.sav'), 'rb') as f:
+        patientLevel = pickle.load(f)
+
+    diffs += [check_parity(byNote, random_features(list(byNote.feature_names_in_), n), tol, 'note level'),
+              check_parity(patientLevel, random_features(list(patientLevel.feature_names_in_), n, kind='bins'), tol, 'patient level')]
+
+    return max(diffs) <= tol
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    path_train = sys.argv[1] if len(sys.argv) > 1 else here
+    model_path = sys.argv[2] if len(sys.argv) > 2 else opj(os.path.dirname(here), 'models')
+    sys.exit(0 if check_models(path_train, model_path) else 1)
@@ -0,0 +1,95 @@
+"""
+Model bundle for the baseline phenotyping algorithm
+"""
+
+# the baseline model needs its column order and its decision threshold, both of which come from the training data.
+# they are computed once here and stored with the classifier, so scoring never has to read the training csvs.
+#
+# build the bundle once with:
+#     python -m utils.model_bundle [folder with lr_text_only_py3_repaired.sav, X_train.csv and y_train.csv]
+
+import sys
+import os
+from os.path import join as opj
+import numpy as np
+import pandas as pd
+import dill
+
+MODEL_NAME = 'lr_text_only_py3_repaired.sav'
+BUNDLE_NAME = 'lr_text_only_bundle.sav'
+
+# training columns the text-only model was not fitted on
+EXCLUDED_FEATURES = ['convulsions seizures','epilepsy and recurrent seizures',
+                     'syncope','n_icds', 'Age', 'Sex',
+                     'n_meds', 'Acetazolamide', 'Brivaracetam', 'Cannabidiol',
+                     'carbamezapine', 'cenobamate', 'clobazam', 'clonazepam', 'clorazepate',
+                     'diazepam', 'eslicarbazepine', 'ethosuximide', 'ezogabine', 'felbamate',
+                     'gabapentin', 'ketamine', 'lacosamide', 'lamotrigine', 'levetiracetam',
+                     'lorazepam', 'methsuximide', 'midazolam', 'oxcarbazepine', 'perampanel',
+                     'phenobarbital', 'phenytoin', 'pregabalin', 'primidone', 'rufinamide',
+                     'tiagabine', 'topiramate', 'valproic acid', 'zonisamide']
+
+
+def optimal_threshold_auc(target, predicted):
+    """
+    Optimal threshold for the precision-recall curve (imbalanced classification): the one with the highest F1 score
+    """
+
+    from sklearn.metrics import precision_recall_curve
+
+    precision, recall, threshold = precision_recall_curve(target, predicted)
+    fscore = (2 * precision * recall) / (precision + recall)
+    ix = np.argmax(fscore)
+    return threshold[ix]
+
+
+def build_bundle(path_train, output=None):
+    """
+    Build the model bundle from the baseline model and its training data, and save it next to the model.
+
+    Inputs:
+        path_train: folder containing the model, X_train.csv and y_train.csv
+        output: where to save the bundle (default: path_train/lr_text_only_bundle.sav)
+
+    Returns the bundle: a dict with the fitted classifier ('model'), the ordered list of features it takes ('features')
+    and the decision threshold ('threshold')
+    """
+
+    clf = dill.load(open(opj(path_train, MODEL_NAME), 'rb'))
+
+    X_train = pd.read_csv(opj(path_train,'X_train.csv'))
+    y_train = pd.read_csv(opj(path_train,'y_train.csv'))
+
+    X_train = X_train.drop(columns=EXCLUDED_FEATURES)
+
+    # Threshold in train
+    y_train_pred = clf.predict_proba(X_train)[:,1]
+    threshold = optimal_threshold_auc(y_train, y_train_pred)
+
+    bundle = {'model': clf, 'features': list(X_train.columns), 'threshold': threshold}
+
+    output = output if output is not None else opj(path_train, BUNDLE_NAME)
+    with open(output, 'wb') as f:
+        dill.dump(bundle, f)
+
+    print('saved model bundle with {} features and threshold {} to {}'.format(len(bundle['features']), threshold, output))
+
+    return bundle
+
+
+def load_bundle(path_train):
+    """
+    Load the model bundle from path_train, building it first from the training data if it does not exist yet
+    """
+
+    filepath = opj(path_train, BUNDLE_NAME)
+    if not os.path.isfile(filepath):
+        print('no model bundle in {}, building it from the training data (only needed once)'.format(path_train))
+        return build_bundle(path_train)
+
+    with open(filepath, 'rb') as f:
+        return dill.load(f)
+
+
+if __name__ == '__main__':
+    build_bundle(sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,89 @@
+"""
+Registry of the pipeline's models
+"""
+
+# every model is loaded once per process and kept, and can be exported to an .npz file next to the original (coefficients,
+# intercept, feature names and threshold). when the .npz is there and not older than the model it came from, the model is read
+# from it, so pure-inference runs never import sklearn or dill nor unpickle anything.
+#
+# export the three models once with:
+#     python -m utils.model_registry [folder of the baseline model bundle] [folder of the patient and note level models]
+
+import sys
+import os
+from os.path import join as opj
+import pickle
+from utils.lr_inference import LogisticModel
+
+BASELINE = 'baseline'
+NOTE_LEVEL = 'note_level'
+PATIENT_LEVEL = 'patient_level'
+
+# model -> (file it is loaded from, exported .npz)
+ARTIFACTS = {BASELINE: ('lr_text_only_bundle.sav', 'lr_text_only_bundle.npz'),
+             NOTE_LEVEL: ('parseFalsePositives_byNote.sav', 'parseFalsePositives_byNote.npz'),
+             PATIENT_LEVEL: ('parseFP_epilepsy_lr.sav', 'parseFP_epilepsy_lr.npz')}
+
+_models = dict()
+
+
+def _fresh(npz, source):
+    return os.path.isfile(npz) and (not os.path.isfile(source) or os.path.getmtime(npz) >= os.path.getmtime(source))
+
+
+def load_sklearn(name, directory):
+    """
+    LogisticModel from the original sklearn model (the baseline bundle is built first if it is missing, see model_bundle.py)
+    """
+
+    if name == BASELINE:
+        from utils.model_bundle import load_bundle
+
+        bundle = load_bundle(directory)
+        return LogisticModel.from_sklearn(bundle['model'], features=bundle['features'], threshold=bundle['threshold'])
+
+    with open(opj(directory, ARTIFACTS[name][0]), 'rb') as f:
+        return LogisticModel.from_sklearn(pickle.load(f))
+
+
+def load_model(name, directory):
+    """
+    The LogisticModel of one of the pipeline's models (BASELINE, NOTE_LEVEL or PATIENT_LEVEL) in directory, loaded once per process.
+    Read from its .npz export if there is an up to date one, from the sklearn model otherwise.
+    """
+
+    key = (name, os.path.abspath(directory))
+    if key not in _models:
+        source, npz = (opj(directory, f) for f in ARTIFACTS[name])
+        _models[key] = LogisticModel.load(npz) if _fresh(npz, source) else load_sklearn(name, directory)
+
+    return _models[key]
+
+
+def clear():
+    """
+    Forget the loaded models (e.g. after exporting or replacing one)
+    """
+
+    _models.clear()
+
+
+def export_models(path_train, model_directory):
+    """
+    Export the baseline model (in path_train) and the note and patient level models (in model_directory) to .npz files next to them
+    """
+
+    for name, directory in ((BASELINE, path_train), (NOTE_LEVEL, model_directory), (PATIENT_LEVEL, model_directory)):
+        output = opj(directory, ARTIFACTS[name][1])
+        model = load_sklearn(name, directory)
+        model.save(output)
+        print('exported {} model with {} features to {}'.format(name, len(model.features or []), output))
+
+    clear()
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    path_train = sys.argv[1] if len(sys.argv) > 1 else here
+    model_directory = sys.argv[2] if len(sys.argv) > 2 else opj(os.path.dirname(here), 'models')
+    export_models(path_train, model_directory)
@@ -8,78 +8,121 @@ Created on Thu Sep  1 14:32:13 2022
 
 import sys
 import os
-import re
-import nltk
+import string
 import numpy as np  
 import pandas as pd
 
-def notes_fnc(notes, col, path):
+class _TranslateTable(dict):
+    # str.translate table that deletes any character it has no entry for (i.e. every non-ascii character)
+    def __missing__(self, key):
+        return None
+
+# keep only [a-zA-Z0-9 \n.], optionally lowercasing at the same time
+_keep = string.ascii_letters + string.digits + ' \n.'
+_cleanTable = _TranslateTable((i, chr(i) if chr(i) in _keep else None) for i in range(128))
+_cleanLowerTable = _TranslateTable((i, chr(i).lower() if chr(i) in _keep else None) for i in range(128))
+
+def normalize_text(text, lower=False):
+    """
+    Vectorized version of re.sub('[^a-zA-Z0-9 \\n\\.]', '', str(x)) over a series of note text, lowercased as well if lower
+    """
     
-    sys.path.insert(0, path) # insert path
+    return text.astype(str).str.translate(_cleanLowerTable if lower else _cleanTable)
+
+
+def merge_notes(n, col, lower=False):
+    """
+    Clean the note text and join it into one text per patient-day.
+    Fragments (rows) of a note are joined in their original order, notes of a day in NoteID order.
+    Pieces shorter than 5 characters are left-padded to 5 before joining and whitespace is collapsed
+    after each join, as in the original three groupby-sum passes.
+    With lower, the text is also lowercased in the same pass (what build_matrix_features does to it anyway).
+    """
+     
+    text = normalize_text(n[col], lower=lower)
     
-    def merge_notes(n, col):
-         
-        n[col] = n[col].astype(str).apply(lambda x: re.sub('[^a-zA-Z0-9 \n\.]', '', x))
-        
-        n[col][n[col].astype(str) == 'nan'] = ' ' 
-        
-        # group all notes
-        
-        # ------------------------------------------------------
-        # Dates
-        # ------------------------------------------------------
-        
-        n['Date'] = n['Date'].astype('datetime64[ns]')
-        
-        # ------------------------------------------------------
-        # Group notes per MRN by ContactDateRealNBR
-        # ------------------------------------------------------
-        
-        #n = n.sort_values(['Date',"NoteID","LinesCount"], ascending=[True,True,True])
-        n = n.sort_values(['Date',"NoteID"], ascending=[True,True])
-        
-        n[col] = n[col].astype(str)
-        
-        #added
-        n[col] = n[col].str.rjust(5)
-        n[col] = n[col].str.ljust(5)
-        
-        n = n.groupby(['PatientID','Date','NoteID'])[col].sum().reset_index()
-        
-        #added
-        n[col] = n[col].apply(lambda x: " ".join(x.split())) # removes duplicated spaces
-        
-        n = n.sort_values(['Date',"NoteID"], ascending=[True,True])
-        
-        #added
-        n[col] = n[col].str.rjust(5)
-        n[col] = n[col].str.ljust(5)
-        
-        n = n.groupby(['PatientID','Date'])[col].sum().reset_index()
-        
-        #added
-        n[col] = n[col].apply(lambda x: " ".join(x.split())) # removes duplicated spaces
-        
-        n = n.sort_values(['Date'], ascending=[True])
-        
-        #added
-        n[col] = n[col].str.rjust(5)
-        n[col] = n[col].str.ljust(5)
-        
-        n = n.groupby(['PatientID','Date'])[col].sum().reset_index()
-        
-        return n
+    # empty notes read as 'nan'. compare with the original case, so lowering does not change which notes are blanked
+    blank = (text == 'nan').to_numpy()
+    if lower and blank.any():
+        blank[blank] = (normalize_text(n[col][blank]) == 'nan').to_numpy()
+    text[blank] = ' ' 
+    
+    # ------------------------------------------------------
+    # Dates
+    # ------------------------------------------------------
+    
+    n = pd.DataFrame({'PatientID': n['PatientID'], 'Date': n['Date'].astype('datetime64[ns]'), 'NoteID': n['NoteID'], col: text})
+    
+    # ------------------------------------------------------
+    # Group notes per MRN by ContactDateRealNBR
+    # ------------------------------------------------------
+    
+    # one stable sort, so the fragments of each note keep their original order
+    n = n.dropna(subset=['PatientID','Date','NoteID'])
+    n = n.sort_values(['PatientID','Date','NoteID'], kind='stable')
+    
+    def join(pieces):
+        return " ".join("".join(x.rjust(5) for x in pieces).split()) # removes duplicated spaces
+    
+    patients = n['PatientID'].tolist()
+    dates = n['Date'].tolist()
+    noteIDs = n['NoteID'].tolist()
+    texts = n[col].tolist()
+    
+    # single pass over the sorted rows: fragments -> note text -> patient-day text
+    dayRows = []
+    merged = []
+    dayNotes = []
+    fragments = []
+    for row in range(len(texts)):
+        fragments.append(texts[row])
+
+        endOfDay = row == len(texts) - 1 or patients[row+1] != patients[row] or dates[row+1] != dates[row]
+        if endOfDay or noteIDs[row+1] != noteIDs[row]:
+            dayNotes.append(join(fragments))
+            fragments = []
+        if endOfDay:
+            merged.append(join(dayNotes).rjust(5))
+            dayNotes = []
+            dayRows.append(row)
+
+    n = n.iloc[dayRows][['PatientID','Date']].reset_index(drop=True)
+    n[col] = np.array(merged, dtype=object)
+
+    return n
+
+
+def notes_fnc(notes, col, path, n_workers=1, tokenizer='nltk', sparse=False, schema=None, compact=False, chunk_size=100000, cache_dir=None):
     
-    notes = merge_notes(notes, col)
+    sys.path.insert(0, path) # insert path
+    
+    # clean, lowercase and merge the text in one pass, so the feature builder gets it ready to tokenize
+    notes = merge_notes(notes, col, lower=True)
      
      
     df = notes
           
     # Build text features matrix
     
-    from utils.build_binary_features_test_only import build_matrix_features
+    from utils.build_binary_features_test_only import build_matrix_features, features_fingerprint
+    from utils.stem_helper import StemCache, SentenceCache
+    
+    # stems and per-sentence features are kept between runs (in cache_dir, utils/ by default), so common words are only ever
+    # stemmed once and copy-forward sentences are only ever tokenized once
+    cache_dir = cache_dir or os.path.join(path,'utils')
+    os.makedirs(cache_dir, exist_ok=True)
+    stem_cache = StemCache(path=os.path.join(cache_dir,'stem_cache.pkl'))
+    # the memo is discarded when the bags of words or the schema change (see features_fingerprint)
+    sentence_cache = SentenceCache(path=os.path.join(cache_dir,'sentence_cache.pkl'), fingerprint=features_fingerprint(schema))
+    
+    df2 = build_matrix_features(df, col, stem_cache=stem_cache, n_workers=n_workers, sentence_cache=sentence_cache, normalized=True, tokenizer=tokenizer, sparse=sparse, schema=schema, compact=compact, chunk_size=chunk_size)
+    
+    stem_cache.save()
+    sentence_cache.save()
     
-    df2 = build_matrix_features(df, col)
+    # sparse and compact features have no missing values to fill
+    if sparse or compact:
+        return df2
     
     cs = list(df2.columns)
     
@@ -0,0 +1,277 @@
+"""
+Index of the notes csv by PatientID and date
+"""
+
+# reading the notes of a handful of patients out of a very large notes.csv should not mean parsing all of it. the indexer
+# goes over the csv once and records, for blocks of consecutive rows of one patient, where they start and end in the file
+# (byte offsets) and the range of their dates. the pipeline then reads only the blocks of the selected patients whose dates
+# overlap one of their admission windows, and parses those bytes alone. the index is saved next to the csv and is only
+# used while the csv has not changed since.
+#
+# any csv works, but the fewer times a patient's notes are interrupted by another patient's, the fewer blocks there are to
+# read: an export sorted by PatientID (and Date within a patient) gives one run of blocks per patient.
+#
+# build the index once with:
+#     python -m utils.notes_index [notes csv] [rows per block]
+# and check reading through an index matches reading the whole file with:
+#     python -m utils.notes_index --check
+
+import sys
+import os
+import io
+import csv
+import numpy as np
+import pandas as pd
+from utils import trend_helper
+
+BLOCK_ROWS = 1000
+
+# date range of a block with a date that does not parse: it is read for any window
+_EARLIEST = np.datetime64(pd.Timestamp.min, 'ns')
+_LATEST = np.datetime64(pd.Timestamp.max, 'ns')
+
+
+def index_path(notes_path):
+    """
+    File the index of notes_path is saved to (notes.csv -> notes.index.npz)
+    """
+
+    return os.path.splitext(notes_path)[0] + '.index.npz'
+
+
+def _records(f):
+    """
+    (byte offset, bytes) of each record of a csv opened in binary mode. A record ends at the first end of line outside
+    quotes, so notes with line breaks are one record (an escaped quote "" does not change the parity)
+    """
+
+    start = 0
+    offset = 0
+    pieces = []
+    quotes = 0
+    for line in f:
+        pieces.append(line)
+        quotes += line.count(b'"')
+        offset += len(line)
+        if quotes % 2 == 0:
+            yield start, b''.join(pieces)
+            start = offset
+            pieces = []
+            quotes = 0
+    if pieces:
+        yield start, b''.join(pieces)
+
+
+def _date_ranges(dates, blocks, nBlocks):
+    """
+    first and last date of each block (block numbers from 0 to nBlocks-1), the widest range for a block with a date that does not parse
+    """
+
+    parsed = pd.to_datetime(pd.Series(dates, dtype=object), format='mixed', errors='coerce')
+    frame = pd.DataFrame({'block': blocks, 'date': parsed})
+    grouped = frame.groupby('block')['date']
+
+    first = grouped.min().reindex(range(nBlocks)).to_numpy(dtype='datetime64[ns]')
+    last = grouped.max().reindex(range(nBlocks)).to_numpy(dtype='datetime64[ns]')
+    unparsed = frame.date.isna().groupby(frame.block).any().reindex(range(nBlocks), fill_value=True).to_numpy()
+    first[unparsed] = _EARLIEST
+    last[unparsed] = _LATEST
+
+    return first, last
+
+
+def _parse_ids(ids, id_col):
+    """
+    The PatientIDs as written in the csv, parsed the way pd.read_csv parses the column (zero-padded 0012 -> 12, 12.0 -> 12.0...).
+    The dtype pandas picks depends on which values the column holds, not how often, so the distinct ids give the dtype of the whole column
+    """
+
+    raw, inverse = np.unique(np.array(ids, dtype=str), return_inverse=True)
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow([id_col])
+    writer.writerows([i] for i in raw)
+    parsed = pd.read_csv(io.StringIO(text.getvalue()))[id_col].to_numpy()
+    if parsed.dtype == object:
+        parsed = parsed.astype(str)
+
+    return parsed[inverse.reshape(-1)]
+
+
+def build_index(notes_path, block_rows=BLOCK_ROWS, id_col='PatientID', date_col='Date'):
+    """
+    Index every block of at most block_rows consecutive rows of one patient in the notes csv, and save it to index_path(notes_path).
+
+    Returns the index: a dict of the header bytes of the csv, and per block its PatientID (parsed as pd.read_csv parses
+    the column), byte range [start, end), number of rows and first and last date
+    """
+
+    ids, starts, ends, nRows, firsts, lasts = [], [], [], [], [], []
+    pending = ([], []) # block, date of the rows whose block has no date range yet
+
+    def flush():
+        if pending[0]:
+            first, last = _date_ranges(pending[1], np.array(pending[0]) - len(firsts), len(ids) - len(firsts))
+            firsts.extend(first)
+            lasts.extend(last)
+            pending[0].clear()
+            pending[1].clear()
+
+    with open(notes_path, 'rb') as f:
+        records = _records(f)
+        _, header = next(records)
+        columns = next(csv.reader([header.decode('utf-8', 'replace')]))
+        idField, dateField = columns.index(id_col), columns.index(date_col)
+
+        for start, record in records:
+            fields = next(csv.reader([record.decode('utf-8', 'replace')]), [])
+            if len(fields) <= max(idField, dateField):
+                continue # blank line
+            patient = fields[idField]
+
+            if not ids or patient != ids[-1] or nRows[-1] == block_rows:
+                if len(pending[0]) >= 100000:
+                    flush()
+                ids.append(patient)
+                starts.append(start)
+                ends.append(start)
+                nRows.append(0)
+            nRows[-1] += 1
+            ends[-1] = start + len(record)
+            pending[0].append(len(ids) - 1)
+            pending[1].append(fields[dateField])
+        flush()
+
+    index = {'header': header,
+             'ids': _parse_ids(ids, id_col),
+             'start': np.array(starts, dtype=np.int64),
+             'end': np.array(ends, dtype=np.int64),
+             'rows': np.array(nRows, dtype=np.int64),
+             'first': np.array(firsts, dtype='datetime64[ns]'),
+             'last': np.array(lasts, dtype='datetime64[ns]')}
+
+    stat = os.stat(notes_path)
+    np.savez(index_path(notes_path), header=np.frombuffer(header, dtype=np.uint8), size=stat.st_size, mtime=stat.st_mtime,
+             **{key: value for key, value in index.items() if key != 'header'})
+
+    return index
+
+
+def load_index(notes_path):
+    """
+    The saved index of notes_path, or None if there is none or the csv changed since it was built
+    """
+
+    path = index_path(notes_path)
+    if not os.path.isfile(path) or not os.path.isfile(notes_path):
+        return None
+
+    with np.load(path) as f:
+        stat = os.stat(notes_path)
+        if int(f['size']) != stat.st_size or float(f['mtime']) != stat.st_mtime:
+            return None
+        index = {key: f[key] for key in ('ids', 'start', 'end', 'rows', 'first', 'last')}
+        index['header'] = f['header'].tobytes()
+
+    return index
+
+
+def read_patient_notes(notes_path, patients, index=None, id_col='PatientID'):
+    """
+    The notes of the patients in notes_path that may fall in one of their admission windows (trend_helper.makeEpisodes),
+    read through the index. Only the blocks of these patients overlapping a window are parsed; the rows come in the order of
+    the csv, so notes_in_windows keeps exactly the notes it would keep from the whole file.
+
+    Inputs:
+        notes_path: notes csv
+        patients: dataframe containing columns "PatientID" and "admit_date"
+        index: output of build_index or load_index (default: the saved index, which must be up to date)
+    """
+
+    if index is None:
+        index = load_index(notes_path)
+        if index is None:
+            raise ValueError('no up to date index of {}, build it with python -m utils.notes_index'.format(notes_path))
+
+    episodes = trend_helper.makeEpisodes(patients)
+
+    # ids are compared by value as in the whole file (12 matches 12.0, not '12'), object columns so numbers and text can be merged
+    missing = ~episodes[id_col].isin(index['ids'])
+    if missing.any():
+        print('warning: {} of {} selected patients have no notes in {} (PatientID {} in the patients, {} in the notes): {}'.format(
+            episodes[id_col][missing].nunique(), episodes[id_col].nunique(), notes_path, episodes[id_col].dtype, index['ids'].dtype,
+            ', '.join(map(str, episodes[id_col][missing].unique()[:10]))))
+
+    blocks = pd.DataFrame({id_col: index['ids'].astype(object), 'block': np.arange(len(index['ids'])), 'first': index['first'], 'last': index['last']})
+    blocks = blocks.merge(episodes.assign(**{id_col: episodes[id_col].astype(object)}), on=id_col, how='inner')
+    blocks = blocks[(blocks['first'] <= blocks.Date_after) & (blocks['last'] >= blocks.Date_before)]
+    selected = np.unique(blocks.block.to_numpy())
+
+    # consecutive blocks are read in one go
+    starts, ends = index['start'][selected], index['end'][selected]
+    joined = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    ranges = zip(np.split(starts, joined), np.split(ends, joined))
+
+    data = [index['header']]
+    with open(notes_path, 'rb') as f:
+        for rangeStarts, rangeEnds in ranges:
+            if len(rangeStarts) == 0:
+                continue
+            f.seek(rangeStarts[0])
+            data.append(f.read(rangeEnds[-1] - rangeStarts[0]))
+    print('read {} of {} notes from {} blocks of the index'.format(index['rows'][selected].sum(), index['rows'].sum(), len(selected)))
+
+    # text ids stay text even if the blocks that were read only hold numbers
+    dtype = {id_col: str} if index['ids'].dtype.kind == 'U' else None
+    return pd.read_csv(io.BytesIO(b''.join(data)), dtype=dtype)
+
+
+def check_index(block_rows=2):
+    """
+    Read the notes of a few patients through the index of small csvs with zero-padded, float-formatted and text PatientIDs,
+    and check notes_in_windows keeps the same notes as from the whole file. Returns True if it does for all of them
+    """
+
+    import tempfile
+    from utils.runBaseline_helper import notes_in_windows
+
+    cases = {'zero-padded': (['0012', '0012', '007', '0012'], [12, 7]),
+             'float-formatted': (['12.0', '7.0', '12.0', '7.0'], [12, 7]),
+             'text': (['A12', '0012', 'A12', '007'], ['A12', '0012'])}
+
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (noteIDs, patientIDs) in cases.items():
+            notes_path = os.path.join(directory, name + '.csv')
+            with open(notes_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['PatientID', 'Date', 'NoteID', 'NoteTXT'])
+                for i, patient in enumerate(noteIDs):
+                    writer.writerow([patient, '2020-0{}-15'.format(i + 2), 'N{}'.format(i), 'note {}\nseizures, "keppra"'.format(i)])
+            patients_path = os.path.join(directory, name + '_patients.csv')
+            pd.DataFrame({'PatientID': patientIDs, 'admit_date': '2020-01-01'}).to_csv(patients_path, index=False)
+            patients = pd.read_csv(patients_path)
+
+            episodes = trend_helper.makeEpisodes(patients)
+            whole = notes_in_windows(episodes, pd.read_csv(notes_path)).reset_index(drop=True)
+            indexed = notes_in_windows(episodes, read_patient_notes(notes_path, patients, build_index(notes_path, block_rows))).reset_index(drop=True)
+
+            same = len(whole) > 0 and whole.equals(indexed)
+            print('{}: {} of {} notes read through the index, {}'.format(name, len(indexed), len(whole), 'same' if same else 'DIFFERENT'))
+            ok = ok and same
+
+    return ok
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--check']:
+        sys.exit(0 if check_index() else 1)
+
+    notes_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.getcwd(), 'input', 'notes.csv')
+    index = build_index(notes_path, int(sys.argv[2]) if len(sys.argv) > 2 else BLOCK_ROWS)
+
+    patientIDs = np.unique(index['ids'])
+    runs = 1 + np.count_nonzero(index['ids'][1:] != index['ids'][:-1]) if len(index['ids']) else 0
+    print('indexed {} notes of {} patients in {} blocks, saved to {}'.format(index['rows'].sum(), len(patientIDs), len(index['ids']), index_path(notes_path)))
+    if runs > len(patientIDs):
+        print('the notes of a patient are spread over {} runs on average, sort the csv by PatientID to read fewer blocks'.format(round(runs / len(patientIDs), 1)))
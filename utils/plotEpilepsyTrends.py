@@ -9,6 +9,7 @@ from os.path import join as opj
 import pandas as pd 
 import numpy as np
 from utils import trend_helper
+from utils.bin_cube import note_level_cube
 import matplotlib.pylab as plt
 import matplotlib.axes as axes
 import seaborn as sns
@@ -18,11 +19,15 @@ warnings.filterwarnings("ignore")
 def plot(**kwargs):
     """
     Requirements: 
-        patients: dataframe containing columns "PatientID" and "admit_date"
+        patients: dataframe containing columns "PatientID" and "admit_date". patients with several admissions get a figure per admission
         scores: output of adjusted scores
         output_path: place to store the figures
+    Optional:
+        cube: bin_cube.note_level_cube of the scores, if it was already built for the patient-level model
     """
 
+    cube = None
+
     for key, value in kwargs.items():
         if key == 'patients':
             patients = value
@@ -30,6 +35,8 @@ def plot(**kwargs):
             scores = value
         if key =='output_path':
             output_path = value
+        if key == 'cube':
+            cube = value
 
     if not os.path.isdir(output_path):
         os.mkdir(output_path) # set up folder for figures if it doesn't exist
@@ -37,19 +44,24 @@ def plot(**kwargs):
     # set up time bins. we want 1 week intervals up to two years
     blockStarts, blockEnds, blockLabels = trend_helper.makeBins(window='week',nYears=2)
 
-    admitDates = patients[['PatientID','admit_date']]
+    # one trajectory per admission episode, from the notes tagged with that episode
+    episodes = trend_helper.makeEpisodes(patients)
+    if cube is None:
+        cube = note_level_cube(scores, patients)
+
+    # extract the time-based features for everyone in these bins, both trajectories from the same cube
+    timeTrends_original = cube.trends('baseline', blockStarts, blockEnds, blockLabels, id_col='EpisodeID')
 
-    # extract the time-based features for everyone in these bins
-    timeTrends_original = trend_helper.parseScores(ScoreData=scores, AdmitDates=admitDates, id_col='PatientID', blockStarts=blockStarts, blockEnds=blockEnds, blockLabels=blockLabels, score_date_col='Date', model_answer_col='baseline_answer', prob_col='baseline_probability', admit_date_col='admit_date')
+    timeTrends_adjusted = cube.trends('adjusted', blockStarts, blockEnds, blockLabels, id_col='EpisodeID')
 
-    timeTrends_adjusted = trend_helper.parseScores(ScoreData=scores, AdmitDates=admitDates, id_col='PatientID', blockStarts=blockStarts, blockEnds=blockEnds, blockLabels=blockLabels, score_date_col='Date', model_answer_col='adjusted_answer', prob_col='adjusted_probability', admit_date_col='admit_date')
+    nEpisodes = episodes.groupby('PatientID')['EpisodeID'].transform('size')
 
-    # do this separately for each patient and save
-    for p in range(0,len(patients)):
+    # do this separately for each patient (and admission) and save
+    for p in range(0,len(episodes)):
 
         plt.figure(figsize= (7,5))
-        figData_baseline = timeTrends_original[timeTrends_original.PatientID==patients.PatientID[p]]
-        figData_adjusted = timeTrends_adjusted[timeTrends_adjusted.PatientID==patients.PatientID[p]]
+        figData_baseline = timeTrends_original[timeTrends_original.EpisodeID==episodes.EpisodeID[p]]
+        figData_adjusted = timeTrends_adjusted[timeTrends_adjusted.EpisodeID==episodes.EpisodeID[p]]
         # make overlapping line plots
         g = sns.lineplot(x='Time Interval',y='Highest Probability',data=figData_baseline, ci=68,color='grey',sort=False,linewidth=1.5,alpha=0.9,linestyle=':')
         g = sns.lineplot(x='Time Interval',y='Highest Probability',data=figData_adjusted, ci=68,color='#77C6BA',sort=False,alpha=1,linewidth=2)
@@ -59,7 +71,9 @@ def plot(**kwargs):
         plt.xticks(np.arange(0,105,13/3))
         plt.xlabel('Time Post-Injury',fontsize=13)
         sns.despine()
-        figName = str(patients.PatientID[p]) + '_epilepsy_probability_lineplot.pdf'
+        figName = str(episodes.PatientID[p]) + '_epilepsy_probability_lineplot.pdf'
+        if nEpisodes[p] > 1:
+            figName = str(episodes.PatientID[p]) + '_' + str(episodes.admit_date[p])[:10] + '_epilepsy_probability_lineplot.pdf'
         plt.savefig(opj(output_path,figName), bbox_inches='tight')
         plt.close()
         
@@ -8,27 +8,73 @@ import sys
 import os 
 from os.path import join as opj 
 import re 
-import nltk
 import numpy as np 
 import pandas as pd
 from datetime import datetime, date, timedelta
 import time
-from dateutil.relativedelta import relativedelta
-import dill
 import warnings
-from future import standard_library
-standard_library.install_aliases()
 import builtins
 warnings.filterwarnings("ignore")
 from utils.notes_function import notes_fnc
+from utils import trend_helper
+from utils import model_registry
+from utils.sparse_features import SparseFeatures
+
+def notes_in_windows(episodes, notes, col='NoteTXT'):
+    """
+    Interval join of the notes to the admission episodes of their patient, keeping the notes dated within any episode window
+    [Date_before, Date_after]. A note falling in the overlapping windows of several admissions is kept (and tokenized) once.
+    Only the patient id and date of the notes take part in the join, the rows that are kept are then taken from notes once,
+    so no note outside its windows is ever copied.
+    Exact duplicate rows are dropped, comparing the text only for rows that already agree on every other column and the text length.
+
+    Inputs:
+        episodes: output of trend_helper.makeEpisodes
+        notes: dataframe containing columns "PatientID", "Date", "NoteID" and the note text
+        col: name of the note text column
+    """
+
+    dates = notes['Date'].astype("datetime64[ns]")
+    rows = np.unique(trend_helper.episodeJoin(episodes, notes['PatientID'].to_numpy(), dates.to_numpy())[0])
+
+    kept = notes.iloc[rows].reset_index(drop=True)
+    kept['Date'] = dates.to_numpy()[rows]
+
+    # exact duplicates, hashing the text of candidate rows only
+    probe = kept.drop(columns=col).assign(length=kept[col].str.len())
+    candidates = probe.duplicated(keep=False).to_numpy()
+    if candidates.any():
+        duplicate = np.zeros(len(kept), dtype=bool)
+        duplicate[candidates] = kept[candidates].duplicated().to_numpy()
+        kept = kept[~duplicate]
+
+    return kept
+
 
 def build_cohort_deidentified(**kwargs):
     """
     Requirements: 
-        patients: dataframe containing columns "PatientID" and "admit_date"
+        patients: dataframe containing columns "PatientID" and "admit_date". a patient may have several rows, one per admission
         notes: dataframe containing all of the notes themselves. columns should be "PatientID", "Date", "NoteID", NoteTXT"
+    Optional:
+        n_workers: number of processes used for feature extraction (default 1)
+        tokenizer: 'nltk' (default) or 'fast', see build_binary_features_test_only.check_tokenizer_parity
+        sparse: return the features as a SparseFeatures (CSR matrix + PatientID/Date rows) instead of a dense dataframe (default False)
+        schema: FeatureSchema to extract the features in, e.g. feature_schema.schema_from_models(...) so the models score the
+            sparse matrix without reordering its columns (default: the bag features only)
+        compact: uint8 features without missing values and a categorical PatientID, to cut the memory of large cohorts (default False)
+        chunk_size: in sparse mode, number of notes extracted at a time before they are compressed (default 100000)
+        cache_dir: folder the stem and sentence caches are kept in between runs (default: utils/ under path)
     """
 
+    n_workers = 1
+    tokenizer = 'nltk'
+    sparse = False
+    schema = None
+    compact = False
+    chunk_size = 100000
+    cache_dir = None
+
     for key, value in kwargs.items():
         if key == 'patients':
             d = value
@@ -36,27 +82,45 @@ def build_cohort_deidentified(**kwargs):
             notes = value
         if key =='path':
             path = value
+        if key == 'n_workers':
+            n_workers = value
+        if key == 'tokenizer':
+            tokenizer = value
+        if key == 'sparse':
+            sparse = value
+        if key == 'schema':
+            schema = value
+        if key == 'compact':
+            compact = value
+        if key == 'chunk_size':
+            chunk_size = value
+        if key == 'cache_dir':
+            cache_dir = value
 
-    # create barriers for time window (injury to 2 years, ignoring the first 7 days)
-    d['Date_before'] = d['admit_date'].astype("datetime64[ns]").apply(lambda x: x + relativedelta(days=7))
-    d['Date_after'] = d['admit_date'].astype("datetime64[ns]").apply(lambda x: x + relativedelta(years=2))
-
-    d = d.drop_duplicates()
+    # create barriers for time window (injury to 2 years, ignoring the first 7 days), one per admission episode
+    episodes = trend_helper.makeEpisodes(d)
 
     # now set up our notes properly and filter to the time window we need
-    notes.Date = notes.Date.astype("datetime64[ns]")
-    notes = pd.merge(d[['PatientID','Date_before','Date_after']], notes, on =['PatientID'], how='outer').drop_duplicates()
-    
-    notes = notes[(notes.Date >= notes.Date_before) & (notes.Date <= notes.Date_after)]
-    
-    notes = notes.drop(columns=['Date_before','Date_after'])
+    notes = notes_in_windows(episodes, notes)
 
     col_notes = 'NoteTXT'
 
     # preprocess and extract binary features from these notes
-    df_notes = notes_fnc(notes, col_notes, path) # check inside function 
+    df_notes = notes_fnc(notes, col_notes, path, n_workers=n_workers, tokenizer=tokenizer, sparse=sparse, schema=schema, compact=compact, chunk_size=chunk_size, cache_dir=cache_dir) # check inside function 
+
+    if sparse:
+        rows = df_notes.rows.drop(columns='NoteTXT') # Date is datetime64 since merge_notes
+        if compact:
+            rows['PatientID'] = rows.PatientID.astype('category')
+        return df_notes.with_rows(rows)
+
+    # Date is datetime64 since merge_notes, so it is not parsed again
+    if compact:
+        # the features are not copied
+        del df_notes['NoteTXT']
+        df_notes['PatientID'] = df_notes.PatientID.astype('category')
+        return df_notes
 
-    df_notes.Date = df_notes.Date.astype("datetime64[ns]")
     df_notes = df_notes.drop(columns='NoteTXT') # can uncomment if you want to retain the note text itself 
 
     return df_notes
@@ -66,15 +130,31 @@ def build_cohort_deidentified(**kwargs):
 def assign_scores(**kwargs):
     """
     Requirements: 
-        df_notes: output from build_cohort_deidentified containing the 
-        path_train: folder containing the original training dataframes and model from the baseline phenotyping algorithm
+        df_notes: output from build_cohort_deidentified containing the features (dense dataframe or SparseFeatures)
+        path_train: folder containing the model bundle of the baseline phenotyping algorithm (see model_bundle.py). it is built from the original training dataframes and model the first time if it is missing
+    Optional:
+        compact: df_notes comes from build_cohort_deidentified(compact=True). the probabilities are float32 and model_answer uint8 (default False)
+        scores_path: folder the scores are saved to, see save_scores (default: path_train)
+        patients: the patients df_notes was built for, saved with the scores so load_scores can check they cover a later selection
     """
 
+    compact = False
+    scores_path = None
+    patients = None
+
     for key, value in kwargs.items():
         if key == 'df_notes':
             df_test = value
         if key == 'path_train':
             path_train = value
+        if key == 'compact':
+            compact = value
+        if key == 'scores_path':
+            scores_path = value
+        if key == 'patients':
+            patients = value
+
+    scores_path = scores_path or path_train
 
     #sys.path.insert(0, path_train) # insert path
 
@@ -91,30 +171,11 @@ def assign_scores(**kwargs):
     # filepath = opj(path_train,filename)
 
     ## repaired version of 'lr_text_only_no_prodigy_binary_model.sav': was optimized for python 2 and gave errors when using in python 3
-    filename = 'lr_text_only_py3_repaired.sav'
-    filepath = opj(path_train,filename)
-    
-    # import model
-    clf = dill.load(open(filepath, 'rb'))
-
-    #------------------------------------------------------------------------
-    # import reference training data
-    #------------------------------------------------------------------------
-    X_train = pd.read_csv(opj(path_train,'X_train.csv'))
-    y_train = pd.read_csv(opj(path_train,'y_train.csv'))
-    
-    exclude = list(['convulsions seizures','epilepsy and recurrent seizures',
-                'syncope','n_icds', 'Age', 'Sex',
-                'n_meds', 'Acetazolamide', 'Brivaracetam', 'Cannabidiol',
-                'carbamezapine', 'cenobamate', 'clobazam', 'clonazepam', 'clorazepate',
-                'diazepam', 'eslicarbazepine', 'ethosuximide', 'ezogabine', 'felbamate',
-                'gabapentin', 'ketamine', 'lacosamide', 'lamotrigine', 'levetiracetam',
-                'lorazepam', 'methsuximide', 'midazolam', 'oxcarbazepine', 'perampanel',
-                'phenobarbital', 'phenytoin', 'pregabalin', 'primidone', 'rufinamide',
-                'tiagabine', 'topiramate', 'valproic acid', 'zonisamide'])
-
-    for i in exclude:
-        X_train = X_train.drop(columns=i)
+    ## bundled with the training feature order and the precision-recall optimal threshold, so the training data is never read here
+    ## loaded once per process, from its .npz export if there is one (see model_registry.py), and scored with numpy (lr_inference.py)
+    clf = model_registry.load_model(model_registry.BASELINE, path_train)
+    features = clf.features
+    threshold = clf.threshold
         
     #%% Features for modeling #########################################
     
@@ -123,52 +184,266 @@ def assign_scores(**kwargs):
     #------------------------------------------------------------------------
     # adjust format of testing data to match training set
     #------------------------------------------------------------------------
-    df_test = df_test.fillna(0) # fill any missing features
+    if isinstance(df_test, SparseFeatures):
+        return assign_scores_sparse(df_test, clf, features, threshold, scores_path, compact, patients)
+
+    if not compact:
+        df_test = df_test.fillna(0) # fill any missing features
     df_test = df_test.loc[:, ~df_test.columns.duplicated()] # drop any duplicated columns
-    X_test = df_test.drop(columns=['PatientID', 'Date'])
 
-    cols_missing = list(X_train.columns[~(X_train.columns.isin(X_test.columns))])
-    
-    for i in cols_missing:
-        X_test[i] = 0
-    
-    X_test = X_test[list(X_train.columns)]
+    X_test = df_test.reindex(columns=features, fill_value=0) # features the notes never fired are all zero
 
     #------------------------------------------------------------------------
     # Test model
     #------------------------------------------------------------------------
     
-    y_train_pred = clf.predict_proba(X_train)[:,1]
-    y_test_pred = clf.predict_proba(X_test)[:,1]
-    
-    #%% Threshold functions #######################################################
-    
-    # Optimal Threshold for Precision-Recall Curve (Imbalanced Classification)
-    
-    from sklearn.metrics import precision_recall_curve
-        
-    def optimal_threshold_auc(target, predicted):
-        precision, recall, threshold = precision_recall_curve(target, predicted)
-        fscore = (2 * precision * recall) / (precision + recall)
-        ix = np.argmax(fscore)
-        return threshold[ix]
-      
-    # Threshold in train
-    threshold = optimal_threshold_auc(y_train, y_train_pred) 
-    
-    y_pred = (clf.predict_proba(X_test*1)[:,1] >= threshold).astype(int)
-    
     probs = clf.predict_proba(X_test)
     
+    y_pred, probs = _compact_scores(probs, threshold, compact)
+    
     # Assign scores
     
     df_scores = pd.concat([df_test, pd.DataFrame(probs,columns=['prob_NO','prob_YES'])], axis = 1)
     df_scores = pd.concat([df_scores, pd.DataFrame(y_pred, columns=['model_answer'])], axis = 1)
     
-    df_scores.to_csv(opj(path_train,'dataset_with_baseline_scores.csv'), index=False)
+    save_scores(df_scores, scores_path, patients)
     
     return df_scores
+
+
+def _compact_scores(probs, threshold, compact):
+    # decisions are taken on the float64 probabilities, so compact mode gives the same answers
+    y_pred = probs[:,1] >= threshold
+    if compact:
+        return y_pred.astype(np.uint8), probs.astype(np.float32)
+    return y_pred.astype(int), probs
+
+
+def assign_scores_sparse(df_test, clf, features, threshold, scores_path, compact=False, patients=None):
+    """
+    assign_scores for SparseFeatures: the model scores the CSR matrix directly, the scores are added to the rows.
+    Saved to scores_path by save_scores
+    """
+
+    df_scores = _score_sparse(df_test, clf, threshold, compact)
+
+    save_scores(df_scores, scores_path, patients)
+
+    return df_scores
+
+
+def _score_sparse(df_test, clf, threshold, compact=False):
+    # the model over the schema columns of the features, or its columns selected from them (missing ones are all zero)
+    clf, X_test = df_test.model_input(clf)
+
+    probs = clf.predict_proba(X_test)
     
-    
-        
-        
\ No newline at end of file
+    y_pred, probs = _compact_scores(probs, threshold, compact)
+
+    rows = df_test.rows.assign(prob_NO=probs[:,0], prob_YES=probs[:,1], model_answer=y_pred)
+    return df_test.with_rows(rows)
+
+
+SCORES_FILE = 'dataset_with_baseline_scores.csv'
+FEATURES_FILE = 'dataset_with_baseline_scores_features.npz'
+PATIENTS_FILE = 'dataset_with_baseline_scores_patients.csv'
+
+
+def save_scores(df_scores, scores_path, patients=None):
+    """
+    Save the output of assign_scores to scores_path: the scores (and dense features) to dataset_with_baseline_scores.csv,
+    sparse features to dataset_with_baseline_scores_features.npz, and the patients they were computed for (if given) to
+    dataset_with_baseline_scores_patients.csv. Files of an earlier run that this one does not write are removed, so
+    load_scores never pairs them with these scores.
+    """
+
+    os.makedirs(scores_path, exist_ok=True)
+    for f in (FEATURES_FILE, PATIENTS_FILE):
+        if os.path.isfile(opj(scores_path, f)):
+            os.remove(opj(scores_path, f))
+
+    if isinstance(df_scores, SparseFeatures):
+        df_scores.rows.to_csv(opj(scores_path, SCORES_FILE), index=False)
+        df_scores.save(opj(scores_path, FEATURES_FILE))
+    else:
+        df_scores.to_csv(opj(scores_path, SCORES_FILE), index=False)
+
+    if patients is not None:
+        save_cohort(patients, opj(scores_path, PATIENTS_FILE))
+
+
+def save_cohort(patients, cohort_path):
+    """
+    Save the admissions (PatientID, admit_date) an output was computed for, for check_cohort
+    """
+
+    patients[['PatientID','admit_date']].drop_duplicates().to_csv(cohort_path, index=False)
+
+
+def check_cohort(cohort_path, patients, what, step):
+    """
+    Raise a ValueError unless the admissions saved to cohort_path (save_cohort) include every admission of patients.
+    what names the output in the message and step the stage that writes it
+    """
+
+    if not os.path.isfile(cohort_path):
+        raise ValueError('the {} in {} do not say which patients they were computed for, run the {} step again'.format(what, os.path.dirname(cohort_path), step))
+
+    # compared as text, with the admission dates parsed (patients.csv and the saved cohort may format them differently)
+    cohort = pd.read_csv(cohort_path)
+    selected = patients[['PatientID','admit_date']].drop_duplicates()
+    selected, cohort = [frame.assign(PatientID=frame.PatientID.astype(str), admit_date=pd.to_datetime(frame.admit_date))
+                        for frame in (selected, cohort)]
+    missing = selected.merge(cohort, how='left', indicator=True)
+    missing = missing[missing._merge == 'left_only']
+    if len(missing):
+        raise ValueError('the {} in {} were computed for other patients: {} of the {} selected admissions are not in them '
+                         '(e.g. PatientID {}), run the {} step for them'.format(what, os.path.dirname(cohort_path), len(missing), len(selected),
+                                                                              ', '.join(missing.PatientID.head(5)), step))
+
+
+def load_scores(scores_path, sparse=False, schema=None, patients=None):
+    """
+    Scores saved by assign_scores (save_scores) in scores_path, to run the later steps again without scoring the notes again.
+    Scores saved with sparse features are loaded as a SparseFeatures (checked against schema if given); with sparse, the
+    scores must have been saved that way.
+    With patients, the scores must have been computed for all of these patients (and admissions), and only their rows are returned.
+    """
+
+    if not os.path.isfile(opj(scores_path, SCORES_FILE)):
+        raise ValueError('no baseline scores in {}, run the baseline step first'.format(scores_path))
+
+    if patients is not None:
+        check_cohort(opj(scores_path, PATIENTS_FILE), patients, 'baseline scores', 'baseline')
+
+    rows = pd.read_csv(opj(scores_path, SCORES_FILE), parse_dates=['Date'])
+    keep = rows.PatientID.isin(patients.PatientID).to_numpy() if patients is not None else None
+
+    if os.path.isfile(opj(scores_path, FEATURES_FILE)):
+        scores = SparseFeatures.load(opj(scores_path, FEATURES_FILE), rows, schema)
+        if keep is not None:
+            scores = scores.take(keep)
+            scores = scores.with_rows(scores.rows.reset_index(drop=True))
+        return scores
+    if sparse:
+        raise ValueError('the baseline scores in {} were saved with dense features, without {}: leave out --sparse or run the baseline step '
+                         'again with --sparse'.format(scores_path, FEATURES_FILE))
+
+    return rows[keep].reset_index(drop=True) if keep is not None else rows
+
+
+def stream_scores(**kwargs):
+    """
+    build_cohort_deidentified(sparse=True) and assign_scores for a notes csv too large to read at once.
+    The notes are read chunk_size rows at a time and only the ones of the cohort inside their windows are kept. Every note is
+    written to one of several bucket files on disk by its PatientID, so all the notes of a patient-day end up in one bucket.
+    The buckets are then merged, extracted and scored a batch of about chunk_size notes at a time, and only the sparse features
+    and scores of each patient-day are carried forward. Memory is bounded by the chunk size, not the size of the notes csv.
+    Same rows, features and scores (in the same order) as the two steps on the whole file; saved like assign_scores.
+
+    Requirements:
+        patients: dataframe containing columns "PatientID" and "admit_date"
+        notes_path: csv of the notes, with columns "PatientID", "Date", "NoteID", "NoteTXT"
+        path: folder containing utils/ (for the stem and sentence caches, unless cache_dir is given)
+        path_train: folder containing the model bundle of the baseline phenotyping algorithm
+    Optional:
+        scores_path: folder the scores are saved to, see save_scores (default: path_train)
+        chunk_size: number of notes read, and then extracted, at a time (default 100000)
+        temp_dir: folder the buckets are written to, they are deleted at the end (default: the system temporary folder)
+        n_workers, tokenizer, schema, compact, cache_dir: as in build_cohort_deidentified and assign_scores
+    """
+
+    import tempfile
+
+    n_workers = 1
+    tokenizer = 'nltk'
+    schema = None
+    compact = False
+    chunk_size = 100000
+    temp_dir = None
+    scores_path = None
+    cache_dir = None
+
+    for key, value in kwargs.items():
+        if key == 'patients':
+            d = value
+        if key == 'notes_path':
+            notes_path = value
+        if key == 'path':
+            path = value
+        if key == 'path_train':
+            path_train = value
+        if key == 'n_workers':
+            n_workers = value
+        if key == 'tokenizer':
+            tokenizer = value
+        if key == 'schema':
+            schema = value
+        if key == 'compact':
+            compact = value
+        if key == 'chunk_size':
+            chunk_size = value
+        if key == 'temp_dir':
+            temp_dir = value
+        if key == 'scores_path':
+            scores_path = value
+        if key == 'cache_dir':
+            cache_dir = value
+
+    clf = model_registry.load_model(model_registry.BASELINE, path_train)
+    episodes = trend_helper.makeEpisodes(d)
+
+    # enough buckets for each to hold well under chunk_size notes, from the size of the first rows of the csv
+    head = pd.read_csv(notes_path, nrows=1000)
+    rowBytes = max(len(head.to_csv(index=False).encode()) / max(len(head), 1), 1)
+    nBuckets = max(int(np.ceil(os.path.getsize(notes_path) / rowBytes / chunk_size)), 1) * 4
+
+    parts = []
+    with tempfile.TemporaryDirectory(dir=temp_dir) as spill:
+        # one pass over the csv: keep the notes of the cohort in their windows, split them into the buckets
+        sizes = np.zeros(nBuckets, dtype=np.int64)
+        files = [[] for _ in range(nBuckets)]
+        nRead = 0
+        for i, chunk in enumerate(pd.read_csv(notes_path, chunksize=chunk_size)):
+            nRead += len(chunk)
+            chunk = notes_in_windows(episodes, chunk)
+            bucket = pd.util.hash_pandas_object(chunk['PatientID'].astype(str), index=False).to_numpy() % nBuckets
+            for b in np.unique(bucket):
+                f = opj(spill, '{}_{}.pkl'.format(b, i))
+                chunk[bucket == b].to_pickle(f)
+                files[b].append(f)
+                sizes[b] += (bucket == b).sum()
+            print('read {} notes of the csv, {} kept'.format(nRead, sizes.sum()))
+
+        # batches of whole buckets of about chunk_size notes, each is a complete set of patient-days.
+        # the pieces of a bucket are read in csv order, so the fragments and duplicates of a note are seen as in the whole file
+        batches = [[]]
+        batchSize = 0
+        for b in np.flatnonzero(sizes):
+            if batches[-1] and batchSize + sizes[b] > chunk_size:
+                batches.append([])
+                batchSize = 0
+            batches[-1].append(b)
+            batchSize += sizes[b]
+
+        for batch in batches:
+            if not batch:
+                continue
+            notes = pd.concat([pd.read_pickle(f) for b in batch for f in files[b]], ignore_index=True)
+            features = build_cohort_deidentified(patients=d, notes=notes, path=path, n_workers=n_workers, tokenizer=tokenizer, sparse=True, schema=schema, chunk_size=chunk_size, cache_dir=cache_dir)
+            del notes
+            parts.append(_score_sparse(features, clf, clf.threshold, compact))
+
+    if not parts:
+        raise ValueError('none of the notes in {} belong to the patients in their time windows'.format(notes_path))
+
+    # the row order of the whole file: the patient-days with a feature first, then the rest, each by PatientID and Date
+    df_scores = SparseFeatures.concat(parts)
+    noFeature = df_scores.matrix.getnnz(axis=1) == 0
+    df_scores = df_scores.take(df_scores.rows.assign(noFeature=noFeature).sort_values(['noFeature','PatientID','Date'], kind='stable').index.to_numpy())
+    if compact:
+        df_scores.rows['PatientID'] = df_scores.rows.PatientID.astype('category')
+
+    save_scores(df_scores, scores_path or path_train, d)
+
+    return df_scores
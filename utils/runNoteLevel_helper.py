@@ -5,21 +5,25 @@ Created by Justin Wheelock (justin.wheelock@yale.edu)
 
 import sys
 import os
-from os.path import join as opj
 import pandas as pd 
 import numpy as np
-import pickle
 from utils import trend_helper
+from utils import model_registry
+from utils.sparse_features import SparseFeatures
 
 def score(**kwargs):
     """
     Requirements: 
-        patients: dataframe containing columns "PatientID" and "admit_date"
-        scores: output of baseline algorithm
+        patients: dataframe containing columns "PatientID" and "admit_date". the output has the admit_date of the episode of each note
+        scores: output of baseline algorithm (dataframe or SparseFeatures)
         temp_path: /utils. place to store any intermediate files
         model_directory: directory containing saved models 
+    Optional:
+        compact: scores come from assign_scores(compact=True). the adjusted probabilities are float32 (default False)
     """
 
+    compact = False
+
     for key, value in kwargs.items():
         if key == 'patients':
             patients = value
@@ -29,41 +33,43 @@ def score(**kwargs):
             temp_path = value
         if key == 'model_directory':
             model_path = value
+        if key == 'compact':
+            compact = value
 
     
     #------------------------------------------------------------------------
     # Load model 
     #------------------------------------------------------------------------
 
-    filepath = opj(model_path,'parseFalsePositives_byNote.sav')
-
-    with open(filepath, "rb") as f:
-        clf = pickle.load(f)
+    # parseFalsePositives_byNote.sav, loaded once per process (see model_registry.py)
+    model = model_registry.load_model(model_registry.NOTE_LEVEL, model_path)
 
     # extract feature columns 
-    feature_names = list(clf.feature_names_in_)
+    feature_names = model.features
 
     #------------------------------------------------------------------------
     # set up features 
     #------------------------------------------------------------------------
-    positive_notes = scores[scores.model_answer==1]
-    
-    test_df = positive_notes[list(positive_notes)[:-5]]
-    
-    cols_missing = set(feature_names) - set(list(test_df))
 
-    for i in cols_missing:
-        test_df[i] = 0 # every dataset may not have every text feature
-    
-    test_df = test_df[feature_names]
+    if isinstance(scores, SparseFeatures):
+        # score the CSR matrix of the positive notes directly, see SparseFeatures.model_input
+        model, test_df = scores.take(scores.rows.model_answer.to_numpy()==1).model_input(model)
+        scores = scores.rows
+    else:
+        test_df = scores[scores.model_answer==1].reindex(columns=feature_names, fill_value=0) # every dataset may not have every text feature
+
+    # only the per-note scores are carried on, not the features
+    scores = scores[['PatientID','Date','model_answer','prob_YES']]
+    positive_notes = scores[scores.model_answer==1]
 
     
     #------------------------------------------------------------------------
     # evaluate 
     #------------------------------------------------------------------------
     threshold = 0.5
-    positive_notes['adjusted_answer'] = (clf.predict_proba(test_df)[:,1] >= threshold).astype(int)
-    positive_notes['adjusted_probability'] = clf.predict_proba(test_df)[:,1]
+    probability = model.prob_yes(test_df)
+    positive_notes['adjusted_answer'] = (probability >= threshold).astype(int)
+    positive_notes['adjusted_probability'] = probability.astype(np.float32) if compact else probability
 
     # now just add these adjusted probabilities back into the main prediction dataframe
 
@@ -77,6 +83,9 @@ def score(**kwargs):
 
     final_scores = final_scores.rename(columns={'model_answer':'baseline_answer','prob_YES':'baseline_probability'})
 
+    # tag every note with the admission episode(s) whose window it falls in, a note in two overlapping windows is listed under both
+    final_scores = trend_helper.tagEpisodes(final_scores, trend_helper.makeEpisodes(patients)).drop(columns='EpisodeID')
+
     return final_scores
     
     
@@ -5,22 +5,30 @@ Created by Justin Wheelock (justin.wheelock@yale.edu)
 
 import sys
 import os
-from os.path import join as opj
 import pandas as pd 
 import numpy as np
-import pickle
 from utils import trend_helper
+from utils import model_registry
+from utils.sparse_features import SparseFeatures
+from utils.bin_cube import BinCube
 
 
 def score(**kwargs):
     """
     Requirements: 
-        patients: dataframe containing columns "PatientID" and "admit_date"
-        scores: output of baseline algorithm
+        patients: dataframe containing columns "PatientID" and "admit_date". a patient with several admissions gets a prediction per admission
+        scores: output of baseline algorithm (dataframe or SparseFeatures)
         temp_path: /utils. place to store any intermediate files
         model_directory: directory containing saved models 
+    Optional:
+        compact: scores come from assign_scores(compact=True). the probabilities are float32 (default False)
+        cube: BinCube of the episodes' scores with a 'baseline' series (bin_cube.note_level_cube), shared with the plots.
+            built from scores if not given
     """
 
+    compact = False
+    cube = None
+
     for key, value in kwargs.items():
         if key == 'patients':
             patients = value
@@ -30,6 +38,14 @@ def score(**kwargs):
             temp_path = value
         if key == 'model_directory':
             model_path = value
+        if key == 'compact':
+            compact = value
+        if key == 'cube':
+            cube = value
+
+    # only the per-row scores are needed here, not the features
+    if isinstance(scores, SparseFeatures):
+        scores = scores.rows
 
     # figure out which patients were flagged as possible epilpsy
     positive_ids = np.unique(scores[scores.model_answer==1].PatientID.to_list())
@@ -38,10 +54,8 @@ def score(**kwargs):
     # Load model 
     #------------------------------------------------------------------------
 
-    filepath = opj(model_path,'parseFP_epilepsy_lr.sav')
-
-    with open(filepath, "rb") as f:
-        clf = pickle.load(f)
+    # parseFP_epilepsy_lr.sav, loaded once per process (see model_registry.py)
+    model = model_registry.load_model(model_registry.PATIENT_LEVEL, model_path)
     
     #------------------------------------------------------------------------
     # set up features
@@ -50,25 +64,32 @@ def score(**kwargs):
     # set up time bins. we want 3 month intervals up to two years
     blockStarts, blockEnds, blockLabels = trend_helper.makeBins(window='3month',nYears=2)
     
-    admitDates = patients[['PatientID','admit_date']]
+    # one set of features per admission episode, from the scores in that episode's window
+    episodes = trend_helper.makeEpisodes(patients)
+    if cube is None:
+        episodeScores = trend_helper.tagEpisodes(scores[['PatientID','Date','model_answer','prob_YES']], episodes, timeline=True) # integer day/month offsets from the admission
+        cube = BinCube.from_scores(episodeScores, {'baseline': ('model_answer','prob_YES')})
 
-    # extract the time-based features for everyone in these bins
-    timeTrends = trend_helper.parseScores(ScoreData=scores, AdmitDates=admitDates, id_col='PatientID', blockStarts=blockStarts, blockEnds=blockEnds, blockLabels=blockLabels, score_date_col='Date', model_answer_col='model_answer', prob_col='prob_YES', admit_date_col='admit_date')
+    # extract the time-based features for everyone in these bins, rolled up from the weekly/monthly cells of the cube
+    timeTrends = cube.trends('baseline', blockStarts, blockEnds, blockLabels, id_col='EpisodeID')
 
     # format for running the classificatin algorithm 
-    regData, cols = trend_helper.gen_regFeats(data=timeTrends, id_col='PatientID', time_col='Time Interval', blockLabels=blockLabels)
+    regData, cols = trend_helper.gen_regFeats(data=timeTrends, id_col='EpisodeID', time_col='Time Interval', blockLabels=blockLabels)
     
     #------------------------------------------------------------------------
     # evaluate
     #------------------------------------------------------------------------
-    ids = regData['PatientID']
-    testData = regData[cols[1:]]
+    # gen_regFeats builds the columns in the order the model was trained on. select them by name anyway, so it can never silently drift
+    testData = regData[model.features if model.features is not None else cols[1:]]
 
     threshold = 0.3
-    regData['prediction'] = (clf.predict_proba(testData)[:,1] >= threshold).astype(int)
-    regData['probability'] = clf.predict_proba(testData)[:,1]
+    probability = model.prob_yes(testData)
+    regData['prediction'] = (probability >= threshold).astype(int)
+    regData['probability'] = probability.astype(np.float32) if compact else probability
+    regData['EpisodeID'] = regData['EpisodeID'].astype(int)
 
-    patientLevel_results = pd.merge(patients[['PatientID','admit_date']],regData[['PatientID','prediction','probability']],on='PatientID',how='left').sort_values(by='PatientID').reset_index(drop=True)
+    episodeResults = pd.merge(episodes[['PatientID','admit_date','EpisodeID']],regData[['EpisodeID','prediction','probability']],on='EpisodeID',how='left')
+    patientLevel_results = pd.merge(patients[['PatientID','admit_date']],episodeResults[['PatientID','admit_date','prediction','probability']],on=['PatientID','admit_date'],how='left').sort_values(by='PatientID').reset_index(drop=True)
 
     print('Identified {} patients with aquired epilepsy out of {} patients'.format(len([patientLevel_results[patientLevel_results.prediction==1]]),len(patients)))
 
@@ -0,0 +1,116 @@
+"""
+Sparse note features
+"""
+
+# each patient-day has a few hundred feature columns that are almost all zero. in sparse mode they are kept as a
+# scipy.sparse CSR matrix next to a small dataframe of per-row values (PatientID, Date, scores...), from feature
+# extraction through to the models, and only turned into a dense dataframe on request (to_frame)
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class SparseFeatures:
+    """
+    Feature matrix of a set of rows with its column vocabulary.
+
+    Inputs:
+        rows: dataframe with the per-row values (PatientID, Date, ...), one row per matrix row
+        matrix: scipy.sparse matrix (rows x columns) of feature values
+        columns: feature name of each matrix column
+        schema: optional FeatureSchema the columns are laid out in (see feature_schema.py)
+    """
+
+    def __init__(self, rows, matrix, columns, schema=None):
+        if matrix.shape != (len(rows), len(columns)):
+            raise ValueError('matrix shape {} does not match {} rows and {} columns'.format(matrix.shape, len(rows), len(columns)))
+        if schema is not None and list(columns) != schema.columns:
+            raise ValueError('columns are not laid out in the schema')
+        self.rows = rows.reset_index(drop=True)
+        self.matrix = sparse.csr_matrix(matrix)
+        self.columns = list(columns)
+        self.schema = schema
+        self.columnIndex = schema.index if schema is not None else {c: i for i, c in reversed(list(enumerate(self.columns)))} # first column of a repeated name wins
+
+    def __len__(self):
+        return len(self.rows)
+
+    def take(self, rows):
+        """
+        Subset of the rows, by boolean mask or positions
+        """
+
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else np.asarray(rows, dtype=int)
+        return SparseFeatures(self.rows.iloc[rows], self.matrix[rows], self.columns, self.schema)
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Rows of several SparseFeatures over the same columns, one after the other
+        """
+
+        return cls(pd.concat([part.rows for part in parts], ignore_index=True), sparse.vstack([part.matrix for part in parts], format='csr'),
+                   parts[0].columns, parts[0].schema)
+
+    def with_rows(self, rows):
+        """
+        Same features with another dataframe of per-row values (e.g. with the scores added)
+        """
+
+        return SparseFeatures(rows, self.matrix, self.columns, self.schema)
+
+    def select(self, columns, dtype=np.float32):
+        """
+        CSR matrix of the given columns in that order. Columns not in the vocabulary are all zero.
+        """
+
+        if self.schema is not None:
+            projection = self.schema.projection(columns)
+        else:
+            projection = np.array([self.columnIndex.get(c, -1) for c in columns], dtype=np.int64)
+
+        matrix = self.matrix.astype(dtype)
+        if (projection < 0).any():
+            matrix = sparse.hstack([matrix, sparse.csr_matrix((len(self), 1), dtype=dtype)], format='csr')
+            projection = np.where(projection < 0, len(self.columns), projection)
+
+        return matrix[:, projection]
+
+    def model_input(self, model):
+        """
+        (model, matrix) to score these rows with a LogisticModel. In the schema layout the model's coefficients are spread
+        over the schema columns and the matrix is used as it is, otherwise the model's columns are selected.
+        """
+
+        if self.schema is not None:
+            return model.on_schema(self.schema), self.matrix
+        return model, self.select(model.features)
+
+    def to_frame(self):
+        """
+        Materialize a dense dataframe: the feature columns (int64, first of any repeated name) followed by the per-row values
+        """
+
+        columns = list(self.columnIndex)
+        features = pd.DataFrame(self.select(columns, dtype=np.int64).toarray(), columns=columns)
+
+        return pd.concat([features, self.rows], axis=1)
+
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+    def save(self, path):
+        """
+        Save the matrix and vocabulary to an .npz file (the per-row values are saved separately, e.g. to csv)
+        """
+
+        np.savez_compressed(path, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                            shape=np.array(self.matrix.shape), columns=np.array(self.columns, dtype=object).astype(str))
+
+    @classmethod
+    def load(cls, path, rows, schema=None):
+        with np.load(path) as f:
+            matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            columns = list(f['columns'])
+        return cls(rows, matrix, columns, schema)
@@ -0,0 +1,269 @@
+"""
+Stemming layer and caches for the binary feature extractor
+"""
+
+# stems each unique token once per batch and keeps bounded caches of stems and of per-sentence features
+# across batches, patients and runs
+
+import os
+import pickle
+import hashlib
+import tempfile
+from itertools import islice
+
+
+class BoundedCache:
+    """
+    Least-recently-used dict with a maximum size, optionally persisted to a pickle file.
+
+    Inputs:
+        maxsize: most entries to keep. the least recently used entries are evicted first
+        path: optional pickle file. the cache is loaded from it if it exists, and written back with save()
+        fingerprint: bytes identifying what the entries were computed from. it is saved with them, and a file saved
+            with another fingerprint is discarded instead of loaded
+    """
+
+    name = 'cache'
+
+    def __init__(self, maxsize, path=None, fingerprint=b''):
+        self.maxsize = maxsize
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.added = None # entries added since track_added(), None when not tracked
+
+        if path is not None and os.path.isfile(path):
+            saved = self._read(path)
+            if saved is not None and saved[0] == fingerprint:
+                self.entries = saved[1]
+                self._evict()
+            elif saved is not None:
+                print('{}: {} was computed from other features, starting empty'.format(self.name, path))
+
+    def _read(self, path, warn=True):
+        """
+        (fingerprint, entries) saved to path, or None (with a warning if warn) if the file cannot be read (e.g. truncated by a crash)
+        """
+
+        try:
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError) as e:
+            if warn:
+                print('warning: {}: cannot read {} ({}: {}), ignoring it'.format(self.name, path, type(e).__name__, e))
+            return None
+
+        # files saved before fingerprints hold the entries alone
+        return saved if isinstance(saved, tuple) else (b'', saved)
+
+    def _evict(self):
+        excess = len(self.entries) - self.maxsize
+        if excess > 0:
+            for key in list(islice(self.entries, excess)):
+                del self.entries[key]
+
+    def track_added(self):
+        """
+        Start recording the entries added from now on (see take_added), e.g. in a worker process holding a copy of the cache
+        """
+
+        self.added = dict()
+
+    def take_added(self):
+        """
+        Return the entries added since track_added() or the last take_added(), and start a new record
+        """
+
+        added, self.added = self.added, dict()
+        return added
+
+    def merge(self, entries):
+        """
+        Add entries computed elsewhere (e.g. take_added() of a worker's copy) that this cache does not hold yet
+        """
+
+        for key, value in entries.items():
+            if key not in self.entries:
+                self.entries[key] = value
+        self._evict()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        print('{}: {:.1%} hit rate ({} lookups, {} entries cached)'.format(self.name, self.hit_rate(), self.hits + self.misses, len(self.entries)))
+
+    def save(self, path=None):
+        """
+        Write the entries to path (default: the path the cache was loaded from). Entries another job saved there since are
+        kept as the least recently used ones, and the file is replaced in one step, so jobs sharing the file never read it half written
+        """
+
+        path = path if path is not None else self.path
+        if path is None:
+            return
+
+        entries = self.entries
+        saved = self._read(path, warn=False) if os.path.isfile(path) else None
+        if saved is not None and saved[0] == self.fingerprint:
+            entries = {key: value for key, value in saved[1].items() if key not in self.entries}
+            entries.update(self.entries)
+            excess = len(entries) - self.maxsize
+            if excess > 0:
+                entries = dict(islice(entries.items(), excess, None))
+
+        f = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.', delete=False)
+        try:
+            with f:
+                pickle.dump((self.fingerprint, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, path)
+        except BaseException:
+            os.remove(f.name)
+            raise
+
+
+class StemCache(BoundedCache):
+    """
+    Bounded cache of Snowball stems, token -> stem
+    """
+
+    name = 'stem cache'
+
+    def __init__(self, maxsize=500000, path=None):
+        super().__init__(maxsize, path)
+        self._stemmer = None
+        # stems the prefilter needed that the cache did not hold (see peek), kept apart so they never evict cached stems
+        self.prefilterStems = BoundedCache(maxsize)
+        self.prefilterStems.name = 'prefilter stem cache'
+
+    @property
+    def stemmer(self):
+        # created on the first token that is not cached yet, so a warm cache never imports nltk
+        if self._stemmer is None:
+            from nltk.stem.snowball import SnowballStemmer
+            self._stemmer = SnowballStemmer(language='english')
+        return self._stemmer
+
+    def lookup(self, tokens):
+        """
+        Return a dict of token -> stem for a collection of unique tokens, stemming only the ones not cached yet
+        """
+
+        stems = self.entries
+        found = dict()
+        for token in tokens:
+            stem = stems.pop(token, None)
+            if stem is None:
+                # the prefilter may have stemmed it already
+                stem = self.prefilterStems.entries.pop(token, None) or self.stemmer.stem(token)
+                self.misses += 1
+                if self.added is not None:
+                    self.added[token] = stem
+            else:
+                self.hits += 1
+            stems[token] = stem # (re)insert at the most recent end
+            found[token] = stem
+
+        self._evict()
+
+        return found
+
+    def peek(self, tokens):
+        """
+        Return a dict of token -> stem like lookup, for the prefilter (could_fire). Cached stems are read without counting a
+        hit or moving them to the recent end, and the other tokens are stemmed through prefilterStems, which counts its own
+        hits and misses. Words of text the prefilter skips then neither inflate the hit rate nor evict the stems extraction uses.
+        """
+
+        stems = self.entries
+        other = self.prefilterStems.entries
+        found = dict()
+        for token in tokens:
+            stem = stems.get(token)
+            if stem is None:
+                stem = other.pop(token, None)
+                if stem is None:
+                    stem = self.stemmer.stem(token)
+                    self.prefilterStems.misses += 1
+                else:
+                    self.prefilterStems.hits += 1
+                other[token] = stem
+            found[token] = stem
+
+        self.prefilterStems._evict()
+
+        return found
+
+    def report(self):
+        super().report()
+        if self.prefilterStems.hits + self.prefilterStems.misses:
+            self.prefilterStems.report()
+
+    def stem_sentences(self, sentences):
+        """
+        Stem a batch of tokenized sentences (list of lists of words). Each unique word is stemmed at most once.
+        """
+
+        vocab = set()
+        for words in sentences:
+            vocab.update(words)
+
+        found = self.lookup(vocab)
+
+        return [[found[w] for w in words] for words in sentences]
+
+
+class SentenceCache(BoundedCache):
+    """
+    Bounded memo of the features fired by a normalized sentence, keyed by a 128-bit hash of its text.
+    Copy-forward text (problem lists, medication lists) repeats the same sentences across many notes,
+    which then skip tokenizing and stemming.
+    The features depend on the bags of words, so a persisted memo should be given their fingerprint
+    (build_binary_features_test_only.features_fingerprint): it is discarded once a bag changes.
+    """
+
+    name = 'sentence cache'
+
+    def __init__(self, maxsize=200000, path=None, fingerprint=b''):
+        super().__init__(maxsize, path, fingerprint)
+
+    @staticmethod
+    def key(sentence, salt=b''):
+        return hashlib.blake2b(salt + sentence.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        """
+        Return the frozenset of features stored for this key, or None if the sentence has not been seen
+        """
+
+        features = self.entries.pop(key, None)
+        if features is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = features # (re)insert at the most recent end
+        return features
+
+    def put(self, key, features):
+        self.entries[key] = frozenset(features)
+        if self.added is not None:
+            self.added[key] = self.entries[key]
+        self._evict()
+
+
+# process-wide caches used when the caller does not provide them
+_default_caches = dict()
+
+def get_stem_cache():
+    if 'stem' not in _default_caches:
+        _default_caches['stem'] = StemCache()
+    return _default_caches['stem']
+
+
+def get_sentence_cache():
+    if 'sentence' not in _default_caches:
+        _default_caches['sentence'] = SentenceCache()
+    return _default_caches['sentence']
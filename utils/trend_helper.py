@@ -10,7 +10,6 @@ import numpy as np
 import time
 from datetime import datetime
 from datetime import datetime, date, timedelta
-from dateutil.relativedelta import relativedelta
 
 def makeBins(**kwargs):
     """
@@ -67,9 +66,197 @@ def makeBins(**kwargs):
 
 
 
+def makeEpisodes(patients, id_col='PatientID', admit_date_col='admit_date'):
+    """
+    Function for listing the admission episodes of a cohort: one row per distinct patient and admit date, so a patient
+    with several brain-injury admissions has several episodes. Each episode gets an EpisodeID (its row number) and the
+    window of notes the baseline algorithm looks at, [admit + 7 days, admit + 2 years].
+
+    Inputs:
+        patients: dataframe with a column for patient id and admission date, one row per admission
+        id_col: column name for patient IDs
+        admit_date_col: column name for the admission date
+    """
+
+    episodes = patients[[id_col, admit_date_col]].drop_duplicates().reset_index(drop=True)
+    admit = episodes[admit_date_col].astype("datetime64[ns]")
+
+    episodes['EpisodeID'] = np.arange(len(episodes))
+    episodes['Date_before'] = admit + pd.Timedelta(days=7)
+    episodes['Date_after'] = admit + pd.DateOffset(years=2)
+
+    return episodes
+
+
+def episodeJoin(episodes, ids, dates, id_col='PatientID'):
+    """
+    Sorted interval join of (patient id, date) pairs to the episode windows [Date_before, Date_after] containing them.
+    Windows of one patient may overlap, so a date can fall in several episodes.
+
+    Inputs:
+        episodes: output of makeEpisodes
+        ids: patient id of each row
+        dates: date of each row
+
+    Returns two arrays with one entry per match, ordered by row then episode: the position of the row and the EpisodeID
+    """
+
+    codes, _ = pd.factorize(pd.concat([episodes[id_col], pd.Series(ids)], ignore_index=True))
+    episodeCodes, rowCodes = codes[:len(episodes)], codes[len(episodes):]
+    dates = pd.Series(dates).astype("datetime64[ns]").to_numpy()
+    before = episodes['Date_before'].to_numpy(dtype='datetime64[ns]')
+    after = episodes['Date_after'].to_numpy(dtype='datetime64[ns]')
+
+    # sort the windows by patient then start. (patient, date) pairs become one integer key through the rank of the date
+    ranks = np.unique(np.concatenate([before, dates]), return_inverse=True)[1].reshape(-1)
+    nRanks = ranks.max() + 1 if len(ranks) else 1
+    episodeKeys = episodeCodes.astype(np.int64) * nRanks + ranks[:len(before)]
+    rowKeys = rowCodes.astype(np.int64) * nRanks + ranks[len(before):]
+
+    order = np.argsort(episodeKeys, kind='stable')
+    episodeKeys, episodeCodes, after = episodeKeys[order], episodeCodes[order], after[order]
+
+    # the windows of the patient starting on or before the date are [first, last)
+    first = np.searchsorted(episodeCodes, rowCodes, side='left')
+    last = np.searchsorted(episodeKeys, rowKeys, side='right')
+    valid = rowCodes >= 0
+
+    rows, matches = [], []
+    maxEpisodes = np.bincount(episodeCodes[episodeCodes >= 0]).max() if (episodeCodes >= 0).any() else 0
+    for k in range(1, maxEpisodes + 1):
+        j = last - k
+        hit = valid & (j >= first)
+        hit[hit] = after[j[hit]] >= dates[hit]
+        rows.append(np.flatnonzero(hit))
+        matches.append(order[j[hit]])
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    matches = np.concatenate(matches) if matches else np.zeros(0, dtype=int)
+    sort = np.lexsort((matches, rows))
+
+    return rows[sort], episodes['EpisodeID'].to_numpy()[matches[sort]]
+
+
+def tagEpisodes(scores, episodes, id_col='PatientID', date_col='Date', admit_date_col='admit_date', timeline=False):
+    """
+    Function for tagging scores (or notes) with the admission episode(s) they belong to. Rows are repeated once per episode
+    whose window contains them and get the EpisodeID and admit date of that episode. Rows outside every window are dropped.
+    The index and row order of scores are kept.
+    With timeline, the integer offsets of each row from the admission of its episode are added too (timelineColumns, see dayOffsets),
+    so the time bins never go back to the dates.
+    """
+
+    dates = scores[date_col].astype("datetime64[ns]")
+    rows, episodeIDs = episodeJoin(episodes, scores[id_col], dates, id_col=id_col)
+
+    tagged = scores.iloc[rows].copy()
+    tagged.insert(tagged.columns.get_loc(id_col)+1, admit_date_col, episodes[admit_date_col].to_numpy()[episodeIDs])
+    tagged['EpisodeID'] = episodeIDs
+
+    if timeline:
+        admit = episodes[admit_date_col].astype("datetime64[ns]").to_numpy()[episodeIDs]
+        for c, offsets in dayOffsets(admit, dates.to_numpy()[rows]).items():
+            tagged[c] = offsets
+
+    return tagged
+
+
+def _addMonths(admit, k):
+    """
+    admit + relativedelta(months=k) for datetime64[ns] arrays: day clipped to the end of shorter months, time of day kept
+    """
+
+    admitDay = admit.astype('datetime64[D]')
+    admitMonth = admit.astype('datetime64[M]')
+    dayOfMonth = admitDay - admitMonth.astype('datetime64[D]')
+    timeOfDay = admit - admitDay.astype('datetime64[ns]')
+
+    month = admitMonth + k
+    monthLength = (month + 1).astype('datetime64[D]') - month.astype('datetime64[D]')
+    return (month.astype('datetime64[D]') + np.minimum(dayOfMonth, monthLength - 1)).astype('datetime64[ns]') + timeOfDay
+
+
+def _monthOffsets(admit, dates):
+    """
+    Whole months from each admit date to each score date, counted the way admit + relativedelta(months=k) steps,
+    and whether the score date falls exactly on that month. Both inputs are datetime64[ns] arrays without NaT.
+    """
+
+    k = (dates.astype('datetime64[M]') - admit.astype('datetime64[M]')).astype(np.int64)
+    k = np.where(_addMonths(admit, k) > dates, k - 1, k)
+
+    return k, _addMonths(admit, k) == dates
+
+
+# integer timeline of a score relative to its admission, see dayOffsets
+timelineColumns = ['DayOffset', 'DayExact', 'MonthOffset', 'MonthExact']
+
+
+def dayOffsets(admit, dates):
+    """
+    Integer timeline of each date relative to its admit date:
+        DayOffset: whole days since admission, and DayExact: whether the date is exactly that many days after it (same time of day)
+        MonthOffset: whole months since admission, stepped like admit + relativedelta(months=k), and MonthExact: whether the date is exactly on it
+    Both inputs are datetime64 arrays without NaT. Returns a dict of arrays (int32 offsets, bool flags) keyed by timelineColumns.
+    """
+
+    admit = np.asarray(admit).astype('datetime64[ns]')
+    dates = np.asarray(dates).astype('datetime64[ns]')
+    day = np.timedelta64(1, 'D').astype('timedelta64[ns]')
+    months, onMonth = _monthOffsets(admit, dates)
+
+    return {'DayOffset': ((dates - admit) // day).astype(np.int32),
+            'DayExact': (dates - admit) % day == np.timedelta64(0, 'ns'),
+            'MonthOffset': months.astype(np.int32),
+            'MonthExact': onMonth}
+
+
+def addTimeline(scores, admit_date_col='admit_date', date_col='Date'):
+    """
+    Function for adding the integer timeline columns (timelineColumns, see dayOffsets) of every score from its admission date,
+    parsing both dates once. Rows missing either date are dropped.
+    """
+
+    admit = scores[admit_date_col].astype('datetime64[ns]')
+    dates = scores[date_col].astype('datetime64[ns]')
+    valid = (admit.notna() & dates.notna()).to_numpy()
+
+    scores = scores[valid].copy()
+    for c, offsets in dayOffsets(admit.to_numpy()[valid], dates.to_numpy()[valid]).items():
+        scores[c] = offsets
+
+    return scores
+
+
+def _assignBlocks(offsets, exact, blockStarts, blockEnds):
+    """
+    Indices (into blockStarts) of the blocks each offset falls in, as (score row, block) pairs.
+    Blocks include both ends, so a score exactly on the end of one block also counts in the next one.
+    Blocks must be sorted and not overlap, as makeBins makes them.
+    """
+
+    rows = np.arange(len(offsets))
+    blockStarts = np.asarray(blockStarts)
+    blockEnds = np.asarray(blockEnds)
+    if len(blockStarts) == 0:
+        return rows[:0], rows[:0]
+
+    # the block starting at or before the offset, if the offset is before its end
+    b = np.searchsorted(blockStarts, offsets, side='right') - 1
+    inside = (b >= 0) & (offsets < blockEnds[b.clip(0)])
+
+    # the block ending exactly on the score date
+    e = np.searchsorted(blockEnds, offsets, side='left').clip(max=len(blockEnds)-1)
+    onEnd = exact & (blockEnds[e] == offsets) & (blockStarts[e] <= offsets)
+
+    return np.concatenate([rows[inside], rows[onEnd]]), np.concatenate([b[inside], e[onEnd]])
+
+
 def parseScores(**kwargs):
     """
-    Function for extracting time-based features from the NLP output. Uses relativeDelta to filter the scores for each patient to a given time window relative to their admission.
+    Function for extracting time-based features from the NLP output. Filters the scores for each patient to a given time window relative to their admission,
+    with the windows stepped like relativedelta would step them.
+    Scores that already carry the integer timeline columns (tagEpisodes(timeline=True) or addTimeline) are binned from those, without AdmitDates.
 
     Inputs:
         ScoreData: dataframe containing all scores we want to parse by time. REQUIRED
@@ -120,50 +307,60 @@ def parseScores(**kwargs):
         if key == 'admit_date_col':
             admit_date_col = value
 
-    timeTrends = pd.DataFrame()
-
     print(np.shape(scoreData))
 
-    ptList = list(np.unique(scoreData[id_col]))
-
-    # loop through each block 
-    for b in range(0,len(blockLabels)):
-        thisBlock = blockLabels[b]
-        blockStart = blockStarts[b]
-        blockEnd = blockEnds[b]
-
-        # identify the true date of the beginning and end of this time window 
-        if 'week' in thisBlock:
-        # add the start and stop of this window to admit date df 
-            admitDates['Date_before'] = admitDates[admit_date_col].astype("datetime64[ns]").apply(lambda x: x + relativedelta(weeks=int(blockStart)))
-            admitDates['Date_after'] = admitDates[admit_date_col].astype("datetime64[ns]").apply(lambda x: x + relativedelta(weeks=int(blockEnd)))
-        if 'month' in thisBlock:
-            admitDates['Date_before'] = admitDates[admit_date_col].astype("datetime64[ns]").apply(lambda x: x + relativedelta(months=blockStart))
-            admitDates['Date_after'] = admitDates[admit_date_col].astype("datetime64[ns]").apply(lambda x: x + relativedelta(months=blockEnd))
-            
-        # merge with scores
-        scores = pd.merge(admitDates[[id_col,'Date_before','Date_after']], scoreData, on=id_col, how='right').drop_duplicates()    
-        # get any scores from within the time window of interest
-        scores = scores[(scores[score_date_col].astype('datetime64[ns]') >= scores['Date_before'].astype('datetime64[ns]')) & (scores[score_date_col].astype('datetime64[ns]') <= scores['Date_after'].astype('datetime64[ns]'))]
-
-        scores = scores.drop(columns=['Date_before','Date_after']) # don't need these any more
-
-        # now loop through all patients in this dataset and extract the time-based features for them 
-        for s in range(0,len(ptList)):
-            sub_scores = scores[scores[id_col]==ptList[s]]
-            # number of hits in this time window
-            n = len(sub_scores[sub_scores[model_answer_col]==1])
-            # create a temp dataframe for this patient
-            temp = pd.DataFrame()
-            temp.at[s,id_col] = ptList[s]
-            temp.at[s,'Time Interval'] = thisBlock
-            temp.at[s,'t'] = b
-            temp.at[s,'Number of Hits'] = n
-            if len(sub_scores)>0: # if they have scores in this window, pull some quantitative info from them 
-                temp.at[s,'Highest Probability'] = np.mean(sub_scores.sort_values(by=prob_col,axis=0,ascending=False)[prob_col][0:1])
-            else:
-                temp.at[s,'Highest Probability'] = 0.2138259917276594 # the baseline probability w/ no information
-            timeTrends = pd.concat([timeTrends,temp])
+    ptList = np.unique(scoreData[id_col])
+
+    if all(c in scoreData.columns for c in timelineColumns):
+        # already on the integer timeline of its admission (tagEpisodes / addTimeline), the dates are not needed
+        scores = scoreData.drop_duplicates()
+    else:
+        # pair every score with every admission of its patient (once per distinct row), then put it on the integer timeline
+        admits = pd.DataFrame({id_col: admitDates[id_col], '_admit': admitDates[admit_date_col].astype("datetime64[ns]")}).drop_duplicates()
+        scores = pd.merge(admits, scoreData.drop(columns=[c for c in timelineColumns if c in scoreData.columns]), on=id_col, how='inner').drop_duplicates()
+        scores = addTimeline(scores, '_admit', score_date_col)
+
+    days = scores['DayOffset'].to_numpy()
+    offsets = {'week': (days // 7, scores['DayExact'].to_numpy() & (days % 7 == 0)),
+               'month': (scores['MonthOffset'].to_numpy(), scores['MonthExact'].to_numpy())}
+
+    # the blocks of each unit every score falls in, from its integer offsets
+    blocks = np.arange(len(blockLabels))
+    units = np.array(['month' if 'month' in l else 'week' if 'week' in l else '' for l in blockLabels])
+    rows, bins = [], []
+    for unit in ('week', 'month'):
+        unitBlocks = blocks[units == unit]
+        if len(unitBlocks) == 0:
+            continue
+        offset, exact = offsets[unit]
+        r, b = _assignBlocks(offset, exact, np.asarray(blockStarts)[unitBlocks], np.asarray(blockEnds)[unitBlocks])
+        rows.append(r)
+        bins.append(unitBlocks[b])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    bins = np.concatenate(bins) if bins else np.zeros(0, dtype=int)
+
+    # number of hits and highest probability per (block, patient) in one groupby
+    pt = pd.Index(ptList).get_indexer(scores[id_col].to_numpy()[rows])
+    cell = bins * len(ptList) + pt
+    inWindow = pd.DataFrame({'hit': scores[model_answer_col].to_numpy()[rows] == 1, 'prob': scores[prob_col].to_numpy(dtype=float)[rows]})
+    agg = inWindow.groupby(cell).agg(hits=('hit', 'sum'), prob=('prob', 'max'))
+
+    nCells = len(blockLabels) * len(ptList)
+    hits = np.zeros(nCells)
+    hits[agg.index] = agg['hits']
+    prob = np.full(nCells, 0.2138259917276594) # the baseline probability w/ no information
+    prob[agg.index] = agg['prob']
+
+    ids = np.tile(ptList, len(blockLabels))
+    if np.issubdtype(ids.dtype, np.number):
+        ids = ids.astype(float)
+
+    timeTrends = pd.DataFrame({id_col: ids,
+                               'Time Interval': np.repeat(np.asarray(blockLabels, dtype=object), len(ptList)),
+                               't': np.repeat(blocks.astype(float), len(ptList)),
+                               'Number of Hits': hits,
+                               'Highest Probability': prob},
+                              index=np.tile(np.arange(len(ptList)), len(blockLabels)))
             
     return timeTrends
 
@@ -171,6 +368,7 @@ def parseScores(**kwargs):
 def gen_regFeats(**kwargs):
     """
     Function to take the features generated in the above function and format them in a way that is suitable for a regression 
+    One row per patient with the columns [id_col, p_<block>, n_<block>, ...] in blockLabels order, the order the patient-level model was trained on
 
     Inputs: 
         data: should be the timeTrends exported with the above function. REQUIRED
@@ -181,6 +379,8 @@ def gen_regFeats(**kwargs):
 
     # set any defaults 
     id_col = 'BDSPPatientID'
+    time_col = 'Time Interval'
+    blockLabels = None
     
     for key, value in kwargs.items():
         if key == 'data':
@@ -192,31 +392,28 @@ def gen_regFeats(**kwargs):
         if key == 'blockLabels':
             blockLabels = value
 
-    ptList = list(np.unique(data[id_col]))
+    if blockLabels is None:
+        blockLabels = list(pd.unique(data[time_col]))
 
-    # initialize dataframe
-    regData = pd.DataFrame()
-    for s in range(0,len(ptList)):
-        subj = ptList[s]
-    
-        subjData = data[data[id_col]==subj].reset_index()
-        # loop through time blocks
-        temp = pd.DataFrame()
-        temp.at[s,id_col] = subj
-        
-        for b in range(0,len(blockLabels)):
-            thisBlock = blockLabels[b]
-            subjData_thisBlock = subjData[subjData[time_col]==thisBlock].reset_index()
-            # add probability for this time block
-            temp.at[s,'p_'+thisBlock] = subjData_thisBlock['Highest Probability'][0]
-            temp.at[s,'n_'+thisBlock] = subjData_thisBlock['Number of Hits'][0]
-        
-        regData = pd.concat([regData,temp])
+    ptList = np.unique(data[id_col])
+
+    # one pivot from the long table (first row per patient and block) to one row per patient
+    first = data.drop_duplicates(subset=[id_col, time_col])
+    wide = first.pivot(index=id_col, columns=time_col, values=['Highest Probability','Number of Hits']).reindex(index=ptList)
+
+    ids = np.asarray(ptList)
+    if np.issubdtype(ids.dtype, np.number):
+        ids = ids.astype(float)
+
+    features = {id_col: ids}
+    for thisBlock in blockLabels:
+        for prefix, value in (('p_', 'Highest Probability'), ('n_', 'Number of Hits')):
+            if (value, thisBlock) in wide.columns:
+                features[prefix+thisBlock] = wide[(value, thisBlock)].to_numpy(dtype=float)
+            else:
+                features[prefix+thisBlock] = np.full(len(ptList), np.nan)
+
+    regData = pd.DataFrame(features, index=range(len(ptList)))
     cols = list(regData)
 
     return regData, cols
-            
-            
-        
-    
-    
\ No newline at end of file